@@ -2,29 +2,56 @@ import os
 import random
 import string
 from datetime import datetime, date, timedelta
-from flask import Flask, request, jsonify, session, send_from_directory, Response, render_template_string
+from flask import Flask, request, jsonify, session, Response, render_template_string, has_request_context
 from dotenv import load_dotenv
 import json
 import traceback
 import base64
 import io
+import gzip
 import hashlib
+import logging
+import logging.handlers
+import sys
+import itertools
+from collections import OrderedDict, deque
+import atexit
+import queue
+import heapq
+import threading
+import concurrent.futures
+import tempfile
+import time
 
 # Inicializar bibliotecas opcionais
 try:
     from supabase import create_client, Client
+    from postgrest.exceptions import APIError
+    ERROS_RESPOSTA_SUPABASE = (APIError,)
     supabase_available = True
 except ImportError:
+    ERROS_RESPOSTA_SUPABASE = ()
     supabase_available = False
     print("⚠️ Supabase não disponível - usando modo simulação")
 
 try:
     import mercadopago
+    from mercadopago.http import HttpClient as MercadoPagoHttpClient
+    import requests
+    from requests.adapters import HTTPAdapter
     mercadopago_available = True
 except ImportError:
+    MercadoPagoHttpClient = object
     mercadopago_available = False
     print("⚠️ MercadoPago não disponível - usando pagamentos simulados")
 
+try:
+    import brotli
+    brotli_available = True
+except ImportError:
+    brotli_available = False
+    print("⚠️ Brotli não disponível - index.html servido apenas com gzip")
+
 try:
     import qrcode
     qrcode_available = True
@@ -70,6 +97,9 @@ PRECO_RASPADINHA_RB = 1.00
 ADMIN_PASSWORD = "paulo10@admin"
 APP_VERSION = "3.0.2"
 
+# Capacidade do buffer circular de logs em memória
+LOGS_MEMORIA_CAPACIDADE = int(os.getenv('LOGS_MEMORIA_CAPACIDADE', '5000'))
+
 # Sistema de armazenamento em memória (fallback quando Supabase não estiver disponível)
 memory_storage = {
     'clientes': [],
@@ -88,24 +118,466 @@ memory_storage = {
         'premio_acumulado': str(PREMIO_INICIAL_ML),
         'percentual_comissao_afiliado': str(PERCENTUAL_COMISSAO_AFILIADO)
     },
-    'logs': []
+    'totais_vendas': {
+        'raspa_brasil': 0,
+        '2para1000': 0
+    },
+    'vendas_diarias': {},
+    'logs': deque(maxlen=LOGS_MEMORIA_CAPACIDADE)
+}
+
+# Índices do armazenamento em memória (venda_id -> registros da venda)
+memory_indices = {
+    'cliente_raspadinhas': {},
+    'cliente_bilhetes': {}
+}
+
+# Disjuntores (circuit breakers) por dependência e operação. Com a taxa de erro da janela acima
+# do limite o disjuntor abre e as chamadas falham na hora com CircuitoAberto, caindo direto no
+# fallback de cada rota. Uma thread de fundo sonda a dependência e, quando ela responde, deixa
+# o disjuntor meio-aberto: uma chamada real de teste decide se ele fecha ou volta a abrir.
+DISJUNTOR_JANELA = float(os.getenv('DISJUNTOR_JANELA', '30'))
+DISJUNTOR_MINIMO_CHAMADAS = int(os.getenv('DISJUNTOR_MINIMO_CHAMADAS', '10'))
+DISJUNTOR_TAXA_ERRO = float(os.getenv('DISJUNTOR_TAXA_ERRO', '0.5'))
+DISJUNTOR_TEMPO_ABERTO = float(os.getenv('DISJUNTOR_TEMPO_ABERTO', '15'))
+disjuntores = {}
+disjuntores_lock = threading.Lock()
+sondas_dependencias = {}
+disjuntores_sonda = {'thread': None, 'pid': None}
+
+class CircuitoAberto(Exception):
+    """Chamada recusada porque o disjuntor da operação está aberto"""
+
+class Disjuntor:
+    """Disjuntor fechado / aberto / meio-aberto com janela móvel de taxa de erro"""
+
+    def __init__(self, nome):
+        self.nome = nome
+        self.dependencia = nome.split(':', 1)[0]
+        self.estado = 'fechado'
+        self.resultados = deque()
+        self.aberto_em = 0.0
+        self.testando = False
+        self.aberturas = 0
+        self.lock = threading.Lock()
+
+    def descartar_antigos(self, agora):
+        """Remove da janela os resultados mais velhos que DISJUNTOR_JANELA"""
+        while self.resultados and agora - self.resultados[0][0] > DISJUNTOR_JANELA:
+            self.resultados.popleft()
+
+    def permitir(self):
+        """Indica se a chamada pode seguir; no meio-aberto libera uma chamada de teste por vez"""
+        with self.lock:
+            if self.estado == 'fechado':
+                return True
+            if self.estado == 'aberto' or self.testando:
+                return False
+            self.testando = True
+            return True
+
+    def abrir(self):
+        """Abre o disjuntor (chamado com o lock adquirido)"""
+        self.estado = 'aberto'
+        self.aberto_em = time.monotonic()
+        self.testando = False
+        self.aberturas += 1
+        self.resultados.clear()
+        iniciar_thread_fundo(disjuntores_sonda, sonda_disjuntores_loop, 'sonda-disjuntores')
+
+    def registrar(self, sucesso):
+        """Registra o resultado de uma chamada e muda de estado se necessário"""
+        agora = time.monotonic()
+        with self.lock:
+            anterior = self.estado
+            if self.estado == 'meio_aberto':
+                if sucesso:
+                    self.estado = 'fechado'
+                    self.testando = False
+                    self.resultados.clear()
+                else:
+                    self.abrir()
+            else:
+                self.resultados.append((agora, sucesso))
+                self.descartar_antigos(agora)
+                falhas = sum(1 for _, ok in self.resultados if not ok)
+                if (self.estado == 'fechado' and len(self.resultados) >= DISJUNTOR_MINIMO_CHAMADAS
+                        and falhas / len(self.resultados) >= DISJUNTOR_TAXA_ERRO):
+                    self.abrir()
+            novo = self.estado
+        
+        if novo != anterior:
+            log_info("disjuntor", f"Disjuntor {self.nome}: {anterior} -> {novo}")
+
+    def resumo(self):
+        """Estado atual do disjuntor para o /health"""
+        with self.lock:
+            self.descartar_antigos(time.monotonic())
+            falhas = sum(1 for _, ok in self.resultados if not ok)
+            return {
+                'estado': self.estado,
+                'chamadas_janela': len(self.resultados),
+                'taxa_erro': round(falhas / len(self.resultados), 3) if self.resultados else 0,
+                'aberturas': self.aberturas
+            }
+
+def obter_disjuntor(nome):
+    """Obtém (ou cria) o disjuntor de uma operação"""
+    disjuntor = disjuntores.get(nome)
+    if disjuntor is None:
+        with disjuntores_lock:
+            disjuntor = disjuntores.setdefault(nome, Disjuntor(nome))
+    return disjuntor
+
+def executar_protegido(nome, funcao, erros_resposta=()):
+    """Executa a chamada através do disjuntor; erros_resposta contam como dependência saudável"""
+    disjuntor = obter_disjuntor(nome)
+    if not disjuntor.permitir():
+        raise CircuitoAberto(nome)
+    try:
+        resultado = funcao()
+    except erros_resposta:
+        disjuntor.registrar(True)
+        raise
+    except Exception:
+        disjuntor.registrar(False)
+        raise
+    disjuntor.registrar(True)
+    return resultado
+
+def estatisticas_disjuntores():
+    """Estado de todos os disjuntores"""
+    with disjuntores_lock:
+        lista = list(disjuntores.values())
+    return {disjuntor.nome: disjuntor.resumo() for disjuntor in lista}
+
+def sondar_disjuntores():
+    """Sonda as dependências com disjuntores abertos há mais de DISJUNTOR_TEMPO_ABERTO"""
+    agora = time.monotonic()
+    with disjuntores_lock:
+        abertos = [d for d in disjuntores.values() if d.estado == 'aberto' and agora - d.aberto_em >= DISJUNTOR_TEMPO_ABERTO]
+    
+    resultados = {}
+    for disjuntor in abertos:
+        if disjuntor.dependencia not in resultados:
+            sonda = sondas_dependencias.get(disjuntor.dependencia)
+            try:
+                resultados[disjuntor.dependencia] = sonda() if sonda else True
+            except Exception:
+                resultados[disjuntor.dependencia] = False
+        
+        with disjuntor.lock:
+            if disjuntor.estado != 'aberto':
+                continue
+            if resultados[disjuntor.dependencia]:
+                disjuntor.estado = 'meio_aberto'
+                disjuntor.testando = False
+            else:
+                disjuntor.aberto_em = time.monotonic()
+
+def sonda_disjuntores_loop():
+    """Thread de fundo que sonda a recuperação das dependências"""
+    while True:
+        time.sleep(1)
+        try:
+            sondar_disjuntores()
+        except Exception as e:
+            log_error("sondar_disjuntores", e)
+
+class ConsultaSupabaseProtegida:
+    """Envolve um builder do Supabase para que o execute() passe pelo disjuntor da operação"""
+
+    def __init__(self, consulta, tabela, operacao=None):
+        self.consulta = consulta
+        self.tabela = tabela
+        self.operacao = operacao
+
+    def __getattr__(self, nome):
+        atributo = getattr(self.consulta, nome)
+        operacao = self.operacao or (nome if nome in ('select', 'insert', 'update', 'upsert', 'delete') else None)
+        if callable(atributo):
+            def encadear(*args, **kwargs):
+                resultado = atributo(*args, **kwargs)
+                if hasattr(resultado, 'execute'):
+                    return ConsultaSupabaseProtegida(resultado, self.tabela, operacao)
+                return resultado
+            return encadear
+        if hasattr(atributo, 'execute'):
+            return ConsultaSupabaseProtegida(atributo, self.tabela, operacao)
+        return atributo
+
+    def execute(self):
+        nome = f"supabase:{self.tabela}:{self.operacao or 'select'}"
+        return executar_protegido(nome, self.consulta.execute, ERROS_RESPOSTA_SUPABASE)
+
+class SupabaseProtegido:
+    """Cliente Supabase cujas consultas passam pelos disjuntores"""
+
+    def __init__(self, cliente):
+        self.cliente = cliente
+
+    def table(self, nome):
+        return ConsultaSupabaseProtegida(self.cliente.table(nome), nome)
+
+    def rpc(self, nome, params=None):
+        return ConsultaSupabaseProtegida(self.cliente.rpc(nome, params or {}), f"rpc.{nome}", 'rpc')
+
+    def __getattr__(self, nome):
+        return getattr(self.cliente, nome)
+
+def sondar_supabase(cliente):
+    """Consulta leve para verificar se o Supabase voltou a responder"""
+    cliente.table('gb_configuracoes').select('gb_chave').limit(1).execute()
+    return True
+
+# Conexão supervisionada com o Supabase. As rotas obtêm o cliente atual por obter_supabase() e
+# uma thread de fundo sonda a conexão, reconectando com backoff exponencial. Política de troca:
+# - sem conexão (ex.: falha ao iniciar), as rotas usam a memória se SUPABASE_FALLBACK_MEMORIA
+#   estiver ativo; caso contrário respondem 503 para não dividir os dados entre workers;
+# - depois de conectado o processo não volta para a memória: falhas passageiras ficam com os
+#   disjuntores e, após SUPABASE_FALHAS_RECONECTAR sondas seguidas sem resposta, um cliente novo
+#   é criado e só substitui o atual quando responder;
+# - uma conexão tardia só é adotada se nenhuma requisição tiver sido atendida pela memória. Depois
+#   disso as sessões e vendas pendentes apontam para ids da memória, que no banco seriam de outros
+#   clientes ou não existiriam: o processo continua na memória e o /health indica que é preciso
+#   reiniciá-lo para passar a usar o banco.
+SUPABASE_SONDA_INTERVALO = float(os.getenv('SUPABASE_SONDA_INTERVALO', '15'))
+SUPABASE_FALHAS_RECONECTAR = int(os.getenv('SUPABASE_FALHAS_RECONECTAR', '3'))
+SUPABASE_BACKOFF_MAXIMO = float(os.getenv('SUPABASE_BACKOFF_MAXIMO', '60'))
+SUPABASE_FALLBACK_MEMORIA = os.getenv('SUPABASE_FALLBACK_MEMORIA', 'true').lower() == 'true'
+conexao_supabase = {
+    'cliente': None,
+    'bruto': None,
+    'falhas_sonda': 0,
+    'tentativas': 0,
+    'reconexoes': 0,
+    'ultimo_erro': None,
+    'conectado_em': None,
+    'memoria_usada': False
 }
+conexao_supabase_lock = threading.Lock()
+supabase_supervisor = {'thread': None, 'pid': None}
+
+def conectar_supabase(sondar=True):
+    """Cria um cliente Supabase novo; com sondar, só o adota se ele responder.
+    Retorna False se o processo já atendeu pela memória e precisa ser reiniciado"""
+    bruto = create_client(SUPABASE_URL, SUPABASE_KEY)
+    if sondar:
+        sondar_supabase(bruto)
+    with conexao_supabase_lock:
+        if conexao_supabase['cliente'] is None and conexao_supabase['memoria_usada']:
+            return False
+        conexao_supabase.update({
+            'cliente': SupabaseProtegido(bruto),
+            'bruto': bruto,
+            'falhas_sonda': 0,
+            'tentativas': 0,
+            'ultimo_erro': None,
+            'conectado_em': datetime.now().isoformat()
+        })
+    return True
+
+def obter_supabase():
+    """Cliente Supabase atual (None enquanto não houver conexão)"""
+    if supabase_available:
+        try:
+            iniciar_thread_fundo(supabase_supervisor, supervisor_supabase_loop, 'supervisor-supabase')
+        except RuntimeError:
+            # Encerramento do interpretador (descargas do atexit): não há mais como iniciar threads
+            pass
+    cliente = conexao_supabase['cliente']
+    if cliente is None and SUPABASE_FALLBACK_MEMORIA and has_request_context() and request.path != '/health':
+        # A requisição vai ser atendida pela memória: a partir daqui o processo não troca de base
+        with conexao_supabase_lock:
+            cliente = conexao_supabase['cliente']
+            if cliente is None:
+                conexao_supabase['memoria_usada'] = True
+    return cliente
+
+def registrar_falha_supabase(campo, erro):
+    """Conta uma falha de sonda ou de reconexão"""
+    with conexao_supabase_lock:
+        conexao_supabase[campo] += 1
+        conexao_supabase['ultimo_erro'] = str(erro)[:200]
+
+def supervisor_supabase_loop():
+    """Thread de fundo que sonda a conexão e reconecta com backoff exponencial"""
+    while True:
+        if conexao_supabase['cliente'] is None and conexao_supabase['memoria_usada']:
+            # Processo preso à memória (ver a política acima): nada a reconectar até reiniciar
+            time.sleep(SUPABASE_SONDA_INTERVALO)
+        elif conexao_supabase['cliente'] is None or conexao_supabase['falhas_sonda'] >= SUPABASE_FALHAS_RECONECTAR:
+            espera = min(2 ** conexao_supabase['tentativas'], SUPABASE_BACKOFF_MAXIMO) * random.uniform(0.5, 1.0)
+            time.sleep(espera)
+            try:
+                if conectar_supabase():
+                    with conexao_supabase_lock:
+                        conexao_supabase['reconexoes'] += 1
+                    log_info("supervisor_supabase", "Conexão com o Supabase restabelecida")
+                else:
+                    log_info("supervisor_supabase", "Supabase voltou, mas o processo já usou a memória: reinicie para usar o banco")
+            except Exception as e:
+                registrar_falha_supabase('tentativas', e)
+                log_error("supervisor_supabase", e, {"tentativas": conexao_supabase['tentativas']})
+        else:
+            time.sleep(SUPABASE_SONDA_INTERVALO)
+            try:
+                sondar_supabase(conexao_supabase['bruto'])
+                with conexao_supabase_lock:
+                    conexao_supabase['falhas_sonda'] = 0
+            except Exception as e:
+                registrar_falha_supabase('falhas_sonda', e)
+
+def estatisticas_conexao_supabase():
+    """Estado da conexão supervisionada para o /health"""
+    with conexao_supabase_lock:
+        dados = {chave: valor for chave, valor in conexao_supabase.items() if chave not in ('cliente', 'bruto')}
+    dados['conectado'] = conexao_supabase['cliente'] is not None
+    dados['fallback_memoria'] = SUPABASE_FALLBACK_MEMORIA
+    dados['reinicio_necessario'] = not dados['conectado'] and dados['memoria_usada']
+    return dados
+
+sondas_dependencias['supabase'] = lambda: sondar_supabase(conexao_supabase['bruto'])
 
 # Inicializar cliente Supabase
-supabase = None
 if supabase_available:
     try:
-        supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
+        conectar_supabase(sondar=False)
         print("✅ Supabase conectado com sucesso")
     except Exception as e:
         print(f"❌ Erro ao conectar com Supabase: {str(e)}")
-        print("📝 Usando sistema de armazenamento em memória")
-        supabase = None
+        if SUPABASE_FALLBACK_MEMORIA:
+            print("📝 Usando sistema de armazenamento em memória até reconectar")
+        else:
+            print("📝 Requisições recusadas (503) até reconectar")
+
+# Cliente HTTP do Mercado Pago: uma sessão compartilhada com pool keep-alive, prazos de conexão
+# e leitura em toda chamada e novas tentativas com jitter apenas para GETs (idempotentes)
+MP_TIMEOUT_CONEXAO = float(os.getenv('MP_TIMEOUT_CONEXAO', '3.05'))
+MP_TIMEOUT_LEITURA = float(os.getenv('MP_TIMEOUT_LEITURA', '10'))
+MP_PRAZO_TOTAL = float(os.getenv('MP_PRAZO_TOTAL', '20'))
+MP_TENTATIVAS_GET = int(os.getenv('MP_TENTATIVAS_GET', '2'))
+MP_POOL_CONEXOES = int(os.getenv('MP_POOL_CONEXOES', '10'))
+MP_STATUS_REPETIR = (429, 500, 502, 503, 504)
+MP_LATENCIAS_AMOSTRA = 200
+
+class ErroServidorMercadoPago(Exception):
+    """Resposta 429/5xx do Mercado Pago depois de esgotadas as tentativas"""
+
+    def __init__(self, resposta):
+        super().__init__(f"Mercado Pago respondeu {resposta['status']}")
+        self.resposta = resposta
+
+class ClienteHttpMercadoPago(MercadoPagoHttpClient):
+    """Transporte do SDK do Mercado Pago com pool de conexões, prazos e métricas por chamada"""
+
+    def __init__(self):
+        self.sessao = requests.Session()
+        adaptador = HTTPAdapter(pool_connections=MP_POOL_CONEXOES, pool_maxsize=MP_POOL_CONEXOES, max_retries=0)
+        self.sessao.mount('https://', adaptador)
+        self.metricas = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def tipo_chamada(method, url):
+        """Identifica o tipo da chamada pelo método e caminho, sem os IDs"""
+        caminho = url.split('://', 1)[-1].split('?', 1)[0]
+        partes = [':id' if parte.isdigit() else parte for parte in caminho.split('/')[1:]]
+        return f"{method} /{'/'.join(partes)}"
+
+    def registrar(self, tipo, duracao, erro, repeticao):
+        """Acumula a latência e o resultado de uma tentativa"""
+        with self.lock:
+            metrica = self.metricas.setdefault(tipo, {
+                'chamadas': 0, 'erros': 0, 'repeticoes': 0,
+                'tempo_total': 0.0, 'latencias': deque(maxlen=MP_LATENCIAS_AMOSTRA)
+            })
+            metrica['chamadas'] += 1
+            metrica['erros'] += 1 if erro else 0
+            metrica['repeticoes'] += 1 if repeticao else 0
+            metrica['tempo_total'] += duracao
+            metrica['latencias'].append(duracao)
+
+    def estatisticas(self):
+        """Resumo das latências (ms) por tipo de chamada"""
+        with self.lock:
+            resumo = {}
+            for tipo, metrica in self.metricas.items():
+                latencias = sorted(metrica['latencias'])
+                resumo[tipo] = {
+                    'chamadas': metrica['chamadas'],
+                    'erros': metrica['erros'],
+                    'repeticoes': metrica['repeticoes'],
+                    'media_ms': round(metrica['tempo_total'] / metrica['chamadas'] * 1000, 1),
+                    'p50_ms': round(latencias[len(latencias) // 2] * 1000, 1),
+                    'p95_ms': round(latencias[int(len(latencias) * 0.95)] * 1000, 1),
+                    'max_ms': round(latencias[-1] * 1000, 1)
+                }
+            return resumo
+
+    @staticmethod
+    def converter_resposta(resposta):
+        """Converte a resposta HTTP no formato esperado pelo SDK"""
+        try:
+            conteudo = resposta.json()
+        except ValueError:
+            conteudo = {'message': resposta.text[:500]}
+        return {'status': resposta.status_code, 'response': conteudo}
+
+    def request(self, method, url, maxretries=None, **kwargs):
+        """Executa a chamada; o timeout e as tentativas do SDK são substituídos pelos daqui"""
+        kwargs['timeout'] = (MP_TIMEOUT_CONEXAO, MP_TIMEOUT_LEITURA)
+        tipo = self.tipo_chamada(method, url)
+        try:
+            return executar_protegido(f"mercadopago:{tipo}", lambda: self.executar(method, url, tipo, kwargs))
+        except ErroServidorMercadoPago as e:
+            # A falha já contou no disjuntor; o SDK recebe a resposta como antes
+            return e.resposta
+
+    def executar(self, method, url, tipo, kwargs):
+        """Faz as tentativas da chamada; 429/5xx na última tentativa contam como falha"""
+        tentativas = 1 + (MP_TENTATIVAS_GET if method == 'GET' else 0)
+        prazo = time.monotonic() + MP_PRAZO_TOTAL
+        
+        for tentativa in range(tentativas):
+            inicio = time.monotonic()
+            try:
+                resposta = self.sessao.request(method, url, **kwargs)
+                erro = None
+            except requests.RequestException as e:
+                resposta, erro = None, e
+            
+            repetir = erro is not None or resposta.status_code in MP_STATUS_REPETIR
+            self.registrar(tipo, time.monotonic() - inicio, repetir, tentativa > 0)
+            
+            # Backoff exponencial com jitter, sem ultrapassar o prazo total da chamada
+            espera = min(0.2 * 2 ** tentativa, 2.0) * random.uniform(0.5, 1.5)
+            ultima = tentativa + 1 >= tentativas or time.monotonic() + espera + MP_TIMEOUT_CONEXAO > prazo
+            if not repetir or ultima:
+                if erro is not None:
+                    raise erro
+                if repetir:
+                    raise ErroServidorMercadoPago(self.converter_resposta(resposta))
+                return self.converter_resposta(resposta)
+            time.sleep(espera)
+
+    def sondar(self):
+        """Chamada leve para verificar se o Mercado Pago voltou a responder"""
+        resposta = self.sessao.get(
+            'https://api.mercadopago.com/v1/payment_methods',
+            headers={'Authorization': f'Bearer {MP_ACCESS_TOKEN}'},
+            timeout=(MP_TIMEOUT_CONEXAO, MP_TIMEOUT_LEITURA)
+        )
+        return resposta.status_code not in MP_STATUS_REPETIR
+
+mp_http_cliente = None
 
 # Configurar Mercado Pago
 try:
     if MP_ACCESS_TOKEN and mercadopago_available:
-        sdk = mercadopago.SDK(MP_ACCESS_TOKEN)
+        mp_http_cliente = ClienteHttpMercadoPago()
+        sondas_dependencias['mercadopago'] = mp_http_cliente.sondar
+        sdk = mercadopago.SDK(MP_ACCESS_TOKEN, http_client=mp_http_cliente)
         print("✅ Mercado Pago SDK configurado com sucesso")
     else:
         print("❌ Token do Mercado Pago não encontrado - usando pagamentos simulados")
@@ -119,15 +591,224 @@ def hash_cpf(cpf):
     """Cria hash do CPF para usar como senha"""
     return hashlib.sha256(cpf.encode()).hexdigest()[:12]
 
+# Logging estruturado: as mensagens vão para uma fila e uma thread (QueueListener) escreve no
+# stdout, então a requisição nunca espera o print. Níveis, formato, amostragem e limite por
+# operação são configurados por variáveis de ambiente.
+LOG_NIVEL = os.getenv('LOG_NIVEL', 'INFO').upper()
+LOG_FORMATO = os.getenv('LOG_FORMATO', 'texto').lower()
+LOG_LIMITE_POR_SEGUNDO = int(os.getenv('LOG_LIMITE_POR_SEGUNDO', '50'))
+LOG_AMOSTRAGEM = {
+    operacao.strip(): float(taxa)
+    for operacao, _, taxa in (
+        item.partition('=') for item in os.getenv('LOG_AMOSTRAGEM', '').split(',') if '=' in item
+    )
+}
+LOG_PREFIXOS = {
+    logging.DEBUG: '🔍',
+    logging.INFO: 'ℹ️',
+    logging.WARNING: '⚠️',
+    logging.ERROR: '❌'
+}
+
+class FormatadorLog(logging.Formatter):
+    """Formata registros como texto (padrão) ou JSON de uma linha"""
+    
+    def format(self, record):
+        operacao = getattr(record, 'operacao', record.name)
+        dados = getattr(record, 'dados', None)
+        
+        if LOG_FORMATO == 'json':
+            return json.dumps({
+                'timestamp': datetime.fromtimestamp(record.created).isoformat(),
+                'nivel': record.levelname.lower(),
+                'operacao': operacao,
+                'mensagem': record.getMessage(),
+                'dados': dados,
+                'pid': record.process
+            }, ensure_ascii=False, default=str)
+        
+        linha = f"{LOG_PREFIXOS.get(record.levelno, 'ℹ️')} [{operacao}] {record.getMessage()}"
+        if dados:
+            linha += f"\n   Dados: {dados}"
+        return linha
+
+logger = logging.getLogger('ganhabrasil')
+logger.setLevel(getattr(logging, LOG_NIVEL, logging.INFO))
+logger.propagate = False
+logs_saida_fila = queue.SimpleQueue()
+logger.addHandler(logging.handlers.QueueHandler(logs_saida_fila))
+logs_listener = {'listener': None, 'pid': None}
+logs_listener_lock = threading.Lock()
+logs_controle = {'janelas': {}, 'suprimidos': {}}
+
+def iniciar_listener_logs():
+    """Inicia a thread que escreve os logs no stdout (uma por processo)"""
+    if logs_listener['pid'] == os.getpid():
+        return
+    with logs_listener_lock:
+        if logs_listener['pid'] == os.getpid():
+            return
+        handler = logging.StreamHandler(sys.stdout)
+        handler.setFormatter(FormatadorLog())
+        listener = logging.handlers.QueueListener(logs_saida_fila, handler, respect_handler_level=False)
+        listener.start()
+        logs_listener['listener'] = listener
+        logs_listener['pid'] = os.getpid()
+
+@atexit.register
+def parar_listener_logs():
+    """Esvazia a fila de saída de logs ao encerrar o processo"""
+    listener = logs_listener['listener']
+    if listener and logs_listener['pid'] == os.getpid():
+        listener.stop()
+
+def log_permitido(operation, nivel):
+    """Aplica amostragem (abaixo de WARNING) e limite de registros por segundo por operação"""
+    if nivel < logging.WARNING:
+        taxa = LOG_AMOSTRAGEM.get(operation)
+        if taxa is not None and random.random() >= taxa:
+            return False
+    
+    if LOG_LIMITE_POR_SEGUNDO <= 0:
+        return True
+    
+    segundo = int(time.monotonic())
+    janela = logs_controle['janelas'].get(operation)
+    if not janela or janela[0] != segundo:
+        logs_controle['janelas'][operation] = [segundo, 1]
+        return True
+    if janela[1] < LOG_LIMITE_POR_SEGUNDO:
+        janela[1] += 1
+        return True
+    
+    suprimidos = logs_controle['suprimidos']
+    suprimidos[operation] = suprimidos.get(operation, 0) + 1
+    return False
+
+def registrar_log(nivel, operation, message, extra_data=None):
+    """Envia um registro estruturado para o logger, se o nível e os limites permitirem"""
+    if not logger.isEnabledFor(nivel) or not log_permitido(operation, nivel):
+        return
+    iniciar_listener_logs()
+    logger.log(nivel, message, extra={'operacao': operation, 'dados': extra_data})
+
+# Gravação assíncrona de logs no Supabase: log_error só enfileira e uma thread de fundo
+# grava em lotes (por tamanho ou intervalo). Fila cheia descarta o registro, sem bloquear.
+LOG_FILA_TAMANHO = int(os.getenv('LOG_FILA_TAMANHO', '1000'))
+LOG_LOTE_TAMANHO = int(os.getenv('LOG_LOTE_TAMANHO', '50'))
+LOG_LOTE_INTERVALO = float(os.getenv('LOG_LOTE_INTERVALO', '2'))
+logs_fila = queue.Queue(maxsize=LOG_FILA_TAMANHO)
+logs_fila_stats = {'enfileirados': 0, 'gravados': 0, 'descartados': 0, 'falhas': 0}
+logs_escritor = {'thread': None, 'pid': None}
+
+def gravar_lote_logs(lote):
+    """Grava um lote de registros em gb_logs_sistema com um único insert"""
+    supabase = obter_supabase()
+    try:
+        supabase.table('gb_logs_sistema').insert(lote).execute()
+        logs_fila_stats['gravados'] += len(lote)
+    except Exception as e:
+        logs_fila_stats['falhas'] += len(lote)
+        registrar_log(logging.ERROR, "gravar_lote_logs", f"{str(e)} - {len(lote)} registro(s) perdido(s)")
+
+def escritor_logs_loop():
+    """Thread de fundo que esvazia a fila de logs em lotes"""
+    while True:
+        try:
+            lote = [logs_fila.get(timeout=LOG_LOTE_INTERVALO)]
+        except queue.Empty:
+            continue
+        
+        prazo = time.monotonic() + LOG_LOTE_INTERVALO
+        while len(lote) < LOG_LOTE_TAMANHO:
+            restante = prazo - time.monotonic()
+            if restante <= 0:
+                break
+            try:
+                lote.append(logs_fila.get(timeout=restante))
+            except queue.Empty:
+                break
+        
+        gravar_lote_logs(lote)
+
+threads_fundo_lock = threading.Lock()
+
+def iniciar_thread_fundo(estado, alvo, nome):
+    """Inicia uma thread de fundo uma vez por processo (também nos workers após o fork)"""
+    thread = estado['thread']
+    if thread and thread.is_alive() and estado['pid'] == os.getpid():
+        return
+    with threads_fundo_lock:
+        thread = estado['thread']
+        if thread and thread.is_alive() and estado['pid'] == os.getpid():
+            return
+        thread = threading.Thread(target=alvo, name=nome, daemon=True)
+        thread.start()
+        estado['thread'] = thread
+        estado['pid'] = os.getpid()
+
+def iniciar_escritor_logs():
+    """Inicia a thread de gravação de logs"""
+    iniciar_thread_fundo(logs_escritor, escritor_logs_loop, 'escritor-logs')
+
+@atexit.register
+def descarregar_logs():
+    """Grava o que restou na fila de logs ao encerrar o processo"""
+    supabase = obter_supabase()
+    lote = []
+    while True:
+        try:
+            lote.append(logs_fila.get_nowait())
+        except queue.Empty:
+            break
+    
+    for i in range(0, len(lote), LOG_LOTE_TAMANHO):
+        if supabase:
+            gravar_lote_logs(lote[i:i + LOG_LOTE_TAMANHO])
+
+# Índices dos logs em memória por tipo (severidade) e operação. Cada índice guarda os
+# registros em ordem de chegada, então o descarte do mais antigo é um popleft.
+memory_log_indices = {'tipo': {}, 'operacao': {}}
+memory_log_ids = itertools.count(1)
+memory_log_lock = threading.Lock()
+
+def registrar_log_memoria(log_entry):
+    """Adiciona um registro ao buffer circular de logs e aos seus índices"""
+    logs = memory_storage['logs']
+    with memory_log_lock:
+        if len(logs) == logs.maxlen:
+            antigo = logs[0]
+            for campo, indice in memory_log_indices.items():
+                registros = indice.get(antigo[campo])
+                if registros:
+                    registros.popleft()
+                    if not registros:
+                        del indice[antigo[campo]]
+        
+        log_entry['id'] = next(memory_log_ids)
+        logs.append(log_entry)
+        for campo, indice in memory_log_indices.items():
+            indice.setdefault(log_entry[campo], deque()).append(log_entry)
+
+def consultar_logs_memoria(operacao=None, tipo=None, inicio=0, quantidade=50):
+    """Pagina os logs em memória, do mais recente ao mais antigo"""
+    with memory_log_lock:
+        if operacao:
+            registros = list(memory_log_indices['operacao'].get(operacao, ()))
+        elif tipo:
+            registros = list(memory_log_indices['tipo'].get(tipo, ()))
+        else:
+            registros = list(memory_storage['logs'])
+    
+    encontrados = (r for r in reversed(registros) if not tipo or r['tipo'] == tipo)
+    return list(itertools.islice(encontrados, inicio, inicio + quantidade))
+
 def log_error(operation, error, extra_data=None):
     """Log de erros centralizado"""
-    error_msg = f"❌ [{operation}] {str(error)}"
-    print(error_msg)
-    if extra_data:
-        print(f"   Dados extras: {extra_data}")
+    supabase = obter_supabase()
+    registrar_log(logging.ERROR, operation, str(error), extra_data)
     
     log_entry = {
-        'id': len(memory_storage['logs']) + 1,
         'operacao': operation,
         'tipo': 'error',
         'mensagem': str(error)[:500],
@@ -137,24 +818,27 @@ def log_error(operation, error, extra_data=None):
     
     if supabase:
         try:
-            supabase.table('gb_logs_sistema').insert({
+            logs_fila.put_nowait({
                 'gb_operacao': operation,
                 'gb_tipo': 'error',
                 'gb_mensagem': str(error)[:500],
                 'gb_dados_extras': json.dumps(extra_data) if extra_data else None,
-                'gb_ip_origem': request.remote_addr if request else None
-            }).execute()
-        except:
-            pass
+                'gb_ip_origem': request.remote_addr if has_request_context() else None
+            })
+            logs_fila_stats['enfileirados'] += 1
+            iniciar_escritor_logs()
+        except queue.Full:
+            logs_fila_stats['descartados'] += 1
     else:
-        memory_storage['logs'].append(log_entry)
+        registrar_log_memoria(log_entry)
 
 def log_info(operation, message, extra_data=None):
     """Log de informações centralizado"""
-    info_msg = f"ℹ️ [{operation}] {message}"
-    print(info_msg)
-    if extra_data:
-        print(f"   Dados: {extra_data}")
+    registrar_log(logging.INFO, operation, message, extra_data)
+
+def log_debug(operation, message, extra_data=None):
+    """Log de depuração (descartado fora de LOG_NIVEL=DEBUG)"""
+    registrar_log(logging.DEBUG, operation, message, extra_data)
 
 def gerar_codigo_antifraude():
     """Gera código único no formato RB-XXXXX-YYY"""
@@ -169,44 +853,258 @@ def gerar_codigo_afiliado():
     timestamp = int(time.time()) % 1000  # últimos 3 dígitos do timestamp
     return f"AF{numero}{timestamp}"
 
-def gerar_milhar():
-    """Gera número aleatório de 4 dígitos entre 1111 e 9999"""
-    return str(random.randint(1111, 9999))
+# Milhares livres por data de sorteio. A lista é recarregada do banco a cada
+# MILHARES_RESSINCRONIZAR segundos (e após um conflito), para enxergar os bilhetes gravados
+# pelos outros workers; a restrição única (gb_data_sorteio, gb_numero_bilhete) impede
+# duplicidade na janela entre recargas. Os números alocados são retirados da lista com troca
+# pelo último elemento (O(1) por bilhete).
+MILHAR_MINIMA = 1111
+MILHAR_MAXIMA = 9999
+MILHARES_RESSINCRONIZAR = float(os.getenv('MILHARES_RESSINCRONIZAR', '30'))
+MILHARES_TENTATIVAS = 3
+milhares_livres = {}
+milhares_lock = threading.Lock()
+
+def carregar_milhares_vendidas(data_sorteio):
+    """Obtém as milhares já vendidas para a data do sorteio"""
+    supabase = obter_supabase()
+    if supabase:
+        vendidas = set()
+        inicio = 0
+        while True:
+            response = supabase.table('gb_cliente_bilhetes').select('gb_numero_bilhete').eq(
+                'gb_data_sorteio', data_sorteio
+            ).order('gb_id').range(inicio, inicio + 999).execute()
+            lote = response.data or []
+            vendidas.update(int(b['gb_numero_bilhete']) for b in lote)
+            if len(lote) < 1000:
+                return vendidas
+            inicio += 1000
+    else:
+        return {
+            int(b['numero_bilhete']) for b in memory_storage['cliente_bilhetes']
+            if b.get('data_sorteio') == data_sorteio
+        }
+
+def alocar_milhares(data_sorteio, quantidade):
+    """Sorteia milhares distintas ainda disponíveis para a data do sorteio"""
+    with milhares_lock:
+        pool = milhares_livres.get(data_sorteio)
+        if pool is None or time.monotonic() - pool['carregado_em'] > MILHARES_RESSINCRONIZAR:
+            vendidas = carregar_milhares_vendidas(data_sorteio)
+            pool = {
+                'livres': [n for n in range(MILHAR_MINIMA, MILHAR_MAXIMA + 1) if n not in vendidas],
+                'carregado_em': time.monotonic()
+            }
+            # Manter apenas o dia corrente em memória
+            milhares_livres.clear()
+            milhares_livres[data_sorteio] = pool
+        
+        livres = pool['livres']
+        if quantidade > len(livres):
+            raise ValueError(f"Restam apenas {len(livres)} milhares para o sorteio de {data_sorteio}")
+        
+        numeros = []
+        for _ in range(quantidade):
+            i = random.randrange(len(livres))
+            livres[i], livres[-1] = livres[-1], livres[i]
+            numeros.append(str(livres.pop()))
+        return numeros
+
+def descartar_milhares(data_sorteio):
+    """Descarta a lista de milhares livres para que a próxima alocação a recarregue do banco"""
+    with milhares_lock:
+        milhares_livres.pop(data_sorteio, None)
+
+def erro_conflito_unico(erro):
+    """Indica se o erro do Supabase é violação de restrição única"""
+    return getattr(erro, 'code', None) == '23505'
 
 def gerar_payment_id():
     """Gera ID de pagamento simulado"""
     return f"PAY_{int(datetime.now().timestamp())}_{random.randint(1000, 9999)}"
 
+def pagamento_simulado(payment_id):
+    """Indica se o payment_id foi gerado pelo pagamento simulado (gerar_payment_id)"""
+    return str(payment_id).startswith('PAY_')
+
+# Cache LRU dos QR codes simulados, indexado pelo texto do payload. Como a quantidade vai de
+# 1 a 50 com dois preços, são poucas imagens distintas; elas são pré-aquecidas na primeira
+# compra de cada processo. Numa falta, a renderização roda no executor e a requisição espera
+# no máximo QR_ESPERA_RENDERIZACAO - se não der tempo, segue sem a imagem.
+QR_CACHE_MAXIMO = int(os.getenv('QR_CACHE_MAXIMO', '256'))
+QR_ESPERA_RENDERIZACAO = float(os.getenv('QR_ESPERA_RENDERIZACAO', '0.5'))
+QR_PREAQUECER = os.getenv('QR_PREAQUECER', 'true').lower() == 'true'
+qr_cache = OrderedDict()
+qr_pendentes = {}
+qr_cache_lock = threading.Lock()
+qr_cache_stats = {'acertos': 0, 'faltas': 0, 'sem_imagem': 0}
+qr_executor = {'executor': None, 'pid': None}
+
+def texto_qr_code(valor):
+    """Texto do payload PIX simulado para um valor"""
+    return f"PIX{valor:.2f}GANHA_BRASIL"
+
+def renderizar_qr_code(qr_text):
+    """Renderiza o QR code em PNG base64 e guarda no cache"""
+    try:
+        qr = qrcode.QRCode(version=1, box_size=10, border=5)
+        qr.add_data(qr_text)
+        qr.make(fit=True)
+        
+        img = qr.make_image(fill_color="black", back_color="white")
+        
+        # Converter para base64
+        img_buffer = io.BytesIO()
+        img.save(img_buffer, format='PNG')
+        img_base64 = base64.b64encode(img_buffer.getvalue()).decode()
+    except Exception as e:
+        log_error("gerar_qr_code_simulado", e)
+        img_base64 = None
+    
+    with qr_cache_lock:
+        qr_pendentes.pop(qr_text, None)
+        if img_base64:
+            qr_cache[qr_text] = img_base64
+            while len(qr_cache) > QR_CACHE_MAXIMO:
+                qr_cache.popitem(last=False)
+    return img_base64
+
+def obter_executor_qr():
+    """Executor de renderização do processo atual, criado (e pré-aquecido) no primeiro uso"""
+    if qr_executor['pid'] == os.getpid():
+        return qr_executor['executor'], False
+    with threads_fundo_lock:
+        if qr_executor['pid'] == os.getpid():
+            return qr_executor['executor'], False
+        qr_executor['executor'] = concurrent.futures.ThreadPoolExecutor(max_workers=2, thread_name_prefix='qr-code')
+        qr_executor['pid'] = os.getpid()
+        return qr_executor['executor'], True
+
+def agendar_qr_code(qr_text):
+    """Retorna a imagem do cache ou o Future da renderização (sem duplicar as pendentes)"""
+    executor, novo = obter_executor_qr()
+    if novo:
+        with qr_cache_lock:
+            qr_pendentes.clear()
+    
+    with qr_cache_lock:
+        img_base64 = qr_cache.get(qr_text)
+        if img_base64:
+            qr_cache.move_to_end(qr_text)
+            return img_base64, None
+        futuro = qr_pendentes.get(qr_text)
+        if futuro is None:
+            futuro = qr_pendentes[qr_text] = executor.submit(renderizar_qr_code, qr_text)
+    
+    if novo and QR_PREAQUECER:
+        preaquecer_qr_codes()
+    return None, futuro
+
+def preaquecer_qr_codes():
+    """Agenda a renderização dos QR codes de todos os valores de compra válidos"""
+    valores = sorted({quantidade * preco for preco in (PRECO_RASPADINHA_RB, PRECO_BILHETE_ML) for quantidade in range(1, 51)})
+    for valor in valores:
+        agendar_qr_code(texto_qr_code(valor))
+
+def estatisticas_cache_qr_code():
+    """Estatísticas do cache de QR codes"""
+    with qr_cache_lock:
+        return dict(qr_cache_stats, itens=len(qr_cache), pendentes=len(qr_pendentes))
+
 def gerar_qr_code_simulado(payment_data):
     """Gera QR code simulado para pagamentos"""
-    qr_text = f"PIX{payment_data['amount']:.2f}GANHA_BRASIL"
+    qr_text = texto_qr_code(payment_data['amount'])
+    img_base64 = None
     
     if qrcode_available:
-        try:
-            qr = qrcode.QRCode(version=1, box_size=10, border=5)
-            qr.add_data(qr_text)
-            qr.make(fit=True)
-            
-            img = qr.make_image(fill_color="black", back_color="white")
-            
-            # Converter para base64
-            img_buffer = io.BytesIO()
-            img.save(img_buffer, format='PNG')
-            img_base64 = base64.b64encode(img_buffer.getvalue()).decode()
-            
-            return {
-                'qr_code': qr_text,
-                'qr_code_base64': img_base64
-            }
-        except Exception as e:
-            log_error("gerar_qr_code_simulado", e)
+        img_base64, futuro = agendar_qr_code(qr_text)
+        if futuro is None:
+            qr_cache_stats['acertos'] += 1
+        else:
+            qr_cache_stats['faltas'] += 1
+            try:
+                img_base64 = futuro.result(timeout=QR_ESPERA_RENDERIZACAO)
+            except concurrent.futures.TimeoutError:
+                qr_cache_stats['sem_imagem'] += 1
     
-    # Fallback sem QR code visual
+    # Sem a imagem o frontend mostra apenas o código (fallback sem QR code visual)
     return {
         'qr_code': qr_text,
-        'qr_code_base64': None
+        'qr_code_base64': img_base64
     }
 
+def indexar_por_venda(colecao, registros):
+    """Adiciona registros ao índice venda_id -> registros da coleção em memória"""
+    indice = memory_indices[colecao]
+    for registro in registros:
+        indice.setdefault(registro['venda_id'], []).append(registro)
+
+def agrupar_por(registros, chave):
+    """Agrupa uma lista de registros pelo valor de uma chave"""
+    grupos = {}
+    for registro in registros:
+        grupos.setdefault(registro.get(chave), []).append(registro)
+    return grupos
+
+def buscar_paginado(montar_query):
+    """Executa uma consulta em páginas de 1000 registros e junta o resultado"""
+    resultado = []
+    inicio = 0
+    while True:
+        response = montar_query().range(inicio, inicio + 999).execute()
+        dados = response.data or []
+        resultado.extend(dados)
+        if len(dados) < 1000:
+            return resultado
+        inicio += 1000
+
+def buscar_por_valores(tabela, coluna, valores, campos='*', ordem=None):
+    """Busca registros com coluna em uma lista de valores (filtro in_), em lotes e paginado"""
+    supabase = obter_supabase()
+    valores = list(dict.fromkeys(v for v in valores if v is not None))
+    resultado = []
+    
+    for i in range(0, len(valores), 200):
+        lote = valores[i:i + 200]
+        
+        def montar_query():
+            # gb_id como desempate único: sem ele a paginação por range pode pular ou repetir linhas
+            return supabase.table(tabela).select(campos).in_(coluna, lote).order(f"{ordem},gb_id" if ordem else 'gb_id')
+        
+        resultado.extend(buscar_paginado(montar_query))
+    
+    return resultado
+
+def criar_raspadinhas_venda(cliente_id, venda_id, quantidade):
+    """Cria todas as raspadinhas de uma venda em uma única operação"""
+    supabase = obter_supabase()
+    quantidade_real = 12 if quantidade == 10 else quantidade
+    
+    if supabase:
+        registros = [{
+            'gb_cliente_id': cliente_id,
+            'gb_venda_id': venda_id,
+            'gb_numero_raspadinha': i + 1,
+            'gb_status': 'disponivel'
+        } for i in range(quantidade_real)]
+        
+        response = supabase.table('gb_cliente_raspadinhas').insert(registros).execute()
+        return response.data or []
+    else:
+        proximo_id = len(memory_storage['cliente_raspadinhas']) + 1
+        registros = [{
+            'id': proximo_id + i,
+            'cliente_id': cliente_id,
+            'venda_id': venda_id,
+            'numero_raspadinha': i + 1,
+            'status': 'disponivel'
+        } for i in range(quantidade_real)]
+        
+        memory_storage['cliente_raspadinhas'].extend(registros)
+        indexar_por_venda('cliente_raspadinhas', registros)
+        return registros
+
 def sanitizar_dados_entrada(data):
     """Sanitiza dados de entrada para evitar problemas de segurança"""
     if isinstance(data, dict):
@@ -221,14 +1119,77 @@ def sanitizar_dados_entrada(data):
         return data.strip()[:500]
     return data
 
+# Cache de configurações com TTL curto. Alterações feitas por qualquer worker tocam o
+# arquivo de invalidação; os demais workers do mesmo host descartam o cache ao ver a nova data.
+CONFIG_CACHE_TTL = float(os.getenv('CONFIG_CACHE_TTL', '5'))
+CONFIG_INVALIDACAO_ARQUIVO = os.getenv(
+    'CONFIG_INVALIDACAO_ARQUIVO',
+    os.path.join(tempfile.gettempdir(), 'ganhabrasil_config.stamp')
+)
+config_cache = {'valores': {}, 'versao': 0}
+config_cache_stats = {}
+config_cache_lock = threading.Lock()
+
+def versao_invalidacao_configuracao():
+    """Obtém a versão (mtime) do sinal de invalidação entre workers"""
+    try:
+        return os.stat(CONFIG_INVALIDACAO_ARQUIVO).st_mtime_ns
+    except OSError:
+        return 0
+
+def sinalizar_invalidacao_configuracao():
+    """Avisa os demais workers que as configurações mudaram"""
+    try:
+        with open(CONFIG_INVALIDACAO_ARQUIVO, 'a'):
+            pass
+        os.utime(CONFIG_INVALIDACAO_ARQUIVO)
+    except OSError as e:
+        log_error("sinalizar_invalidacao_configuracao", e)
+    return versao_invalidacao_configuracao()
+
+def registrar_acesso_cache_configuracao(chave, acerto):
+    """Contabiliza acertos e falhas do cache por chave"""
+    stats = config_cache_stats.setdefault(chave, {'hits': 0, 'misses': 0})
+    stats['hits' if acerto else 'misses'] += 1
+
+def estatisticas_cache_configuracao():
+    """Retorna contadores de acertos/falhas do cache de configurações"""
+    with config_cache_lock:
+        return {chave: dict(stats) for chave, stats in config_cache_stats.items()}
+
+def gravar_cache_configuracao(chave, valor):
+    """Atualiza o cache local após uma escrita e invalida o dos demais workers"""
+    versao = sinalizar_invalidacao_configuracao()
+    with config_cache_lock:
+        config_cache['valores'][chave] = (valor, time.monotonic() + CONFIG_CACHE_TTL)
+        config_cache['versao'] = max(config_cache['versao'], versao)
+
 def obter_configuracao(chave, valor_padrao=None):
     """Obtém valor de configuração"""
+    supabase = obter_supabase()
     if supabase:
+        agora = time.monotonic()
+        versao = versao_invalidacao_configuracao()
+        
+        with config_cache_lock:
+            if versao > config_cache['versao']:
+                config_cache['valores'].clear()
+                config_cache['versao'] = versao
+            
+            item = config_cache['valores'].get(chave)
+            if item and item[1] > agora:
+                registrar_acesso_cache_configuracao(chave, True)
+                return item[0] if item[0] is not None else valor_padrao
+            registrar_acesso_cache_configuracao(chave, False)
+        
         try:
             response = supabase.table('gb_configuracoes').select('gb_valor').eq('gb_chave', chave).execute()
-            if response.data:
-                return response.data[0]['gb_valor']
-            return valor_padrao
+            valor = response.data[0]['gb_valor'] if response.data else None
+            
+            with config_cache_lock:
+                config_cache['valores'][chave] = (valor, agora + CONFIG_CACHE_TTL)
+            
+            return valor if valor is not None else valor_padrao
         except Exception as e:
             log_error("obter_configuracao", e, {"chave": chave})
             return valor_padrao
@@ -237,6 +1198,7 @@ def obter_configuracao(chave, valor_padrao=None):
 
 def atualizar_configuracao(chave, valor, tipo='geral'):
     """Atualiza valor de configuração"""
+    supabase = obter_supabase()
     if supabase:
         try:
             response = supabase.table('gb_configuracoes').update({
@@ -251,6 +1213,8 @@ def atualizar_configuracao(chave, valor, tipo='geral'):
                     'gb_tipo': tipo
                 }).execute()
             
+            gravar_cache_configuracao(chave, str(valor))
+            
             log_info("atualizar_configuracao", f"{chave} = {valor}")
             return response.data is not None
         except Exception as e:
@@ -261,6 +1225,36 @@ def atualizar_configuracao(chave, valor, tipo='geral'):
         log_info("atualizar_configuracao", f"{chave} = {valor} (memoria)")
         return True
 
+premio_manual_lock = threading.Lock()
+
+def reivindicar_premio_manual():
+    """Retira o prêmio manual liberado de forma atômica - só uma raspagem o recebe"""
+    supabase = obter_supabase()
+    if supabase:
+        premio = obter_configuracao('premio_manual_liberado', '')
+        if not premio:
+            return None
+        
+        try:
+            # Update condicional: só limpa se o valor ainda for o prêmio lido
+            response = supabase.table('gb_configuracoes').update({
+                'gb_valor': '',
+                'gb_atualizado_em': datetime.now().isoformat()
+            }).eq('gb_chave', 'premio_manual_liberado').eq('gb_valor', premio).execute()
+        except Exception as e:
+            log_error("reivindicar_premio_manual", e)
+            return None
+        
+        # Em ambos os casos o prêmio não está mais disponível para este worker
+        gravar_cache_configuracao('premio_manual_liberado', '')
+        return premio if response.data else None
+    else:
+        with premio_manual_lock:
+            premio = memory_storage['configuracoes'].get('premio_manual_liberado', '')
+            if premio:
+                memory_storage['configuracoes']['premio_manual_liberado'] = ''
+            return premio or None
+
 def validar_session_admin():
     """Valida se o usuário está logado como admin"""
     return session.get('admin_logado', False)
@@ -271,6 +1265,7 @@ def validar_session_cliente():
 
 def obter_cliente_atual():
     """Obtém dados do cliente logado"""
+    supabase = obter_supabase()
     if not validar_session_cliente():
         return None
     
@@ -292,20 +1287,231 @@ def obter_cliente_atual():
 
 def obter_total_vendas(tipo_jogo='raspa_brasil'):
     """Obtém total de vendas aprovadas"""
+    supabase = obter_supabase()
     if supabase:
         try:
-            response = supabase.table('gb_vendas').select('gb_quantidade').eq('gb_tipo_jogo', tipo_jogo).eq('gb_status', 'completed').execute()
-            if response.data:
-                total = sum(venda['gb_quantidade'] for venda in response.data)
-                return total
-            return 0
+            # Soma feita no banco (função gb_total_vendas em supabase_funcoes.sql)
+            response = supabase.rpc('gb_total_vendas', {'p_tipo_jogo': tipo_jogo}).execute()
+            return int(response.data or 0)
+        except Exception as e:
+            log_error("obter_total_vendas_rpc", e, {"tipo_jogo": tipo_jogo})
+        
+        try:
+            vendas = buscar_paginado(lambda: supabase.table('gb_vendas').select('gb_quantidade').eq(
+                'gb_tipo_jogo', tipo_jogo
+            ).eq('gb_status', 'completed').order('gb_id'))
+            return sum(venda['gb_quantidade'] for venda in vendas)
         except Exception as e:
             log_error("obter_total_vendas", e, {"tipo_jogo": tipo_jogo})
             return 0
     else:
-        vendas = memory_storage.get('vendas', [])
-        total = sum(v['quantidade'] for v in vendas if v.get('tipo_jogo') == tipo_jogo and v.get('status') == 'completed')
-        return total
+        return memory_storage['totais_vendas'].get(tipo_jogo, 0)
+
+def registrar_venda_aprovada_memoria(venda):
+    """Atualiza totais e consolidado diário em memória quando uma venda é aprovada"""
+    totais = memory_storage['totais_vendas']
+    totais[venda['tipo_jogo']] = totais.get(venda['tipo_jogo'], 0) + venda['quantidade']
+    
+    chave = (venda.get('data_criacao', '')[:10], venda['tipo_jogo'])
+    consolidado = memory_storage['vendas_diarias'].setdefault(chave, {'quantidade': 0, 'receita': 0.0})
+    consolidado['quantidade'] += venda['quantidade']
+    consolidado['receita'] += venda.get('valor_total', 0)
+
+def obter_vendas_diarias(data_inicio=None, data_fim=None):
+    """Obtém o consolidado diário de vendas aprovadas (dia x jogo) no período"""
+    supabase = obter_supabase()
+    if supabase:
+        try:
+            # Consolidado mantido pelo gatilho (tabela gb_vendas_diarias em supabase_funcoes.sql)
+            def montar_query():
+                query = supabase.table('gb_vendas_diarias').select('gb_data, gb_tipo_jogo, gb_quantidade, gb_receita')
+                if data_inicio:
+                    query = query.gte('gb_data', data_inicio)
+                if data_fim:
+                    query = query.lte('gb_data', data_fim)
+                return query.order('gb_data,gb_tipo_jogo')
+            
+            linhas = [{
+                'data': r['gb_data'],
+                'tipo_jogo': r['gb_tipo_jogo'],
+                'quantidade': r['gb_quantidade'] or 0,
+                'receita': float(r['gb_receita'] or 0)
+            } for r in buscar_paginado(montar_query)]
+            if linhas:
+                return linhas
+        except Exception as e:
+            log_error("obter_vendas_diarias_consolidado", e)
+        
+        # Consolidado ausente ou vazio (tabela/gatilho não criados ou sem carga inicial):
+        # agrupar as vendas aprovadas diretamente
+        def montar_query_vendas():
+            query = supabase.table('gb_vendas').select(
+                'gb_data_criacao, gb_tipo_jogo, gb_quantidade, gb_valor_total'
+            ).eq('gb_status', 'completed')
+            if data_inicio:
+                query = query.gte('gb_data_criacao', data_inicio + ' 00:00:00')
+            if data_fim:
+                query = query.lte('gb_data_criacao', data_fim + ' 23:59:59')
+            return query.order('gb_id')
+        
+        consolidado = {}
+        for venda in buscar_paginado(montar_query_vendas):
+            chave = ((venda.get('gb_data_criacao') or '')[:10], venda['gb_tipo_jogo'])
+            valores = consolidado.setdefault(chave, {'quantidade': 0, 'receita': 0.0})
+            valores['quantidade'] += venda['gb_quantidade'] or 0
+            valores['receita'] += float(venda['gb_valor_total'] or 0)
+        
+        return [{
+            'data': dia,
+            'tipo_jogo': tipo_jogo,
+            'quantidade': valores['quantidade'],
+            'receita': valores['receita']
+        } for (dia, tipo_jogo), valores in sorted(consolidado.items())]
+    else:
+        return [{
+            'data': dia,
+            'tipo_jogo': tipo_jogo,
+            'quantidade': valores['quantidade'],
+            'receita': valores['receita']
+        } for (dia, tipo_jogo), valores in sorted(memory_storage['vendas_diarias'].items())
+            if (not data_inicio or dia >= data_inicio) and (not data_fim or dia <= data_fim)]
+
+# Reservas de estoque do Raspa Brasil. Cada pagamento criado segura suas unidades até ser
+# aprovado ou até o prazo expirar. Com Supabase as reservas ficam na tabela gb_reservas_estoque
+# e são feitas pela função gb_reservar_estoque (supabase_funcoes.sql), que verifica e reserva
+# numa única transação - compartilhadas por todos os workers. As estruturas locais abaixo são
+# usadas no modo memória e como contingência se a função não responder; nelas o total vendido
+# é ressincronizado periodicamente com o banco.
+RESERVA_ESTOQUE_TTL = int(os.getenv('RESERVA_ESTOQUE_TTL', '900'))
+ESTOQUE_RESSINCRONIZAR = int(os.getenv('ESTOQUE_RESSINCRONIZAR', '30'))
+estoque_rb = {
+    'vendidas': 0,
+    'reservadas': 0,
+    'reservas': {},
+    'expiracoes': [],
+    'sincronizado_em': None
+}
+estoque_lock = threading.Lock()
+
+def liberar_reservas_expiradas(agora):
+    """Libera reservas vencidas (chamar com estoque_lock adquirido)"""
+    expiracoes = estoque_rb['expiracoes']
+    while expiracoes and expiracoes[0][0] <= agora:
+        expira, chave = heapq.heappop(expiracoes)
+        reserva = estoque_rb['reservas'].get(chave)
+        if reserva and reserva['expira'] == expira:
+            del estoque_rb['reservas'][chave]
+            estoque_rb['reservadas'] -= reserva['quantidade']
+
+def sincronizar_estoque():
+    """Atualiza o total vendido a partir do banco quando o valor local está velho"""
+    agora = time.monotonic()
+    with estoque_lock:
+        sincronizado_em = estoque_rb['sincronizado_em']
+        if sincronizado_em is not None and agora - sincronizado_em < ESTOQUE_RESSINCRONIZAR:
+            return
+        estoque_rb['sincronizado_em'] = agora
+    
+    vendidas = obter_total_vendas('raspa_brasil')
+    with estoque_lock:
+        estoque_rb['vendidas'] = vendidas
+
+def obter_estoque_rb():
+    """Obtém vendidas, reservadas e disponíveis do Raspa Brasil"""
+    supabase = obter_supabase()
+    sincronizar_estoque()
+    with estoque_lock:
+        liberar_reservas_expiradas(time.monotonic())
+        vendidas = estoque_rb['vendidas']
+        reservadas = estoque_rb['reservadas']
+    
+    if supabase:
+        try:
+            response = supabase.rpc('gb_estoque_reservado', {'p_tipo_jogo': 'raspa_brasil'}).execute()
+            reservadas += int(response.data or 0)
+        except Exception as e:
+            log_error("obter_estoque_rb", e)
+    
+    return {
+        'vendidas': vendidas,
+        'reservadas': reservadas,
+        'disponiveis': max(TOTAL_RASPADINHAS - vendidas - reservadas, 0)
+    }
+
+def reservar_estoque(chave, quantidade):
+    """Reserva unidades do Raspa Brasil; retorna (sucesso, disponíveis)"""
+    supabase = obter_supabase()
+    if supabase:
+        try:
+            response = supabase.rpc('gb_reservar_estoque', {
+                'p_chave': chave,
+                'p_quantidade': quantidade,
+                'p_total': TOTAL_RASPADINHAS,
+                'p_ttl_segundos': RESERVA_ESTOQUE_TTL
+            }).execute()
+            resultado = response.data[0]
+            return bool(resultado['reservado']), int(resultado['disponiveis'])
+        except Exception as e:
+            log_error("reservar_estoque_rpc", e, {"chave": chave})
+    
+    return reservar_estoque_local(chave, quantidade)
+
+def reservar_estoque_local(chave, quantidade):
+    """Reserva unidades no controle local do processo; retorna (sucesso, disponíveis)"""
+    sincronizar_estoque()
+    with estoque_lock:
+        agora = time.monotonic()
+        liberar_reservas_expiradas(agora)
+        
+        disponiveis = TOTAL_RASPADINHAS - estoque_rb['vendidas'] - estoque_rb['reservadas']
+        if quantidade > disponiveis:
+            return False, max(disponiveis, 0)
+        
+        expira = agora + RESERVA_ESTOQUE_TTL
+        estoque_rb['reservas'][chave] = {'quantidade': quantidade, 'expira': expira}
+        estoque_rb['reservadas'] += quantidade
+        heapq.heappush(estoque_rb['expiracoes'], (expira, chave))
+        return True, disponiveis - quantidade
+
+def alterar_reserva_banco(operacao, chave, nova_chave=None):
+    """Renomeia ou remove uma reserva em gb_reservas_estoque (sem efeito no modo memória)"""
+    supabase = obter_supabase()
+    if not supabase:
+        return
+    try:
+        tabela = supabase.table('gb_reservas_estoque')
+        if operacao == 'renomear':
+            tabela.update({'gb_chave': nova_chave}).eq('gb_chave', chave).execute()
+        else:
+            tabela.delete().eq('gb_chave', chave).execute()
+    except Exception as e:
+        log_error(f"{operacao}_reserva", e, {"chave": chave})
+
+def renomear_reserva(chave, nova_chave):
+    """Associa a reserva ao payment_id definitivo"""
+    alterar_reserva_banco('renomear', chave, nova_chave)
+    with estoque_lock:
+        reserva = estoque_rb['reservas'].pop(chave, None)
+        if reserva:
+            estoque_rb['reservas'][nova_chave] = reserva
+            heapq.heappush(estoque_rb['expiracoes'], (reserva['expira'], nova_chave))
+
+def confirmar_reserva(chave):
+    """Converte a reserva em venda quando o pagamento é aprovado"""
+    alterar_reserva_banco('remover', chave)
+    with estoque_lock:
+        reserva = estoque_rb['reservas'].pop(chave, None)
+        if reserva:
+            estoque_rb['reservadas'] -= reserva['quantidade']
+            estoque_rb['vendidas'] += reserva['quantidade']
+
+def cancelar_reserva(chave):
+    """Devolve ao estoque as unidades de uma reserva"""
+    alterar_reserva_banco('remover', chave)
+    with estoque_lock:
+        reserva = estoque_rb['reservas'].pop(chave, None)
+        if reserva:
+            estoque_rb['reservadas'] -= reserva['quantidade']
 
 def sortear_premio_novo_sistema():
     """Sistema de prêmios manual - Só libera quando admin autorizar"""
@@ -315,9 +1521,8 @@ def sortear_premio_novo_sistema():
             log_info("sortear_premio_novo_sistema", "Sistema desativado pelo admin")
             return None
 
-        premio_manual = obter_configuracao('premio_manual_liberado', '')
+        premio_manual = reivindicar_premio_manual()
         if premio_manual:
-            atualizar_configuracao('premio_manual_liberado', '')
             log_info("sortear_premio_novo_sistema", f"Prêmio manual liberado: {premio_manual}")
             return premio_manual
 
@@ -336,8 +1541,195 @@ def obter_premio_acumulado():
     except:
         return PREMIO_INICIAL_ML
 
+afiliados_contadores_lock = threading.Lock()
+AFILIADOS_CONTADORES_TENTATIVAS = 5
+
+def incrementar_contadores_afiliado_condicional(supabase, afiliado_id, clicks, vendas, comissao):
+    """Contingência sem a função no banco: lê os contadores e grava condicionado aos valores lidos"""
+    deltas = {
+        'gb_total_clicks': clicks,
+        'gb_total_vendas': vendas,
+        'gb_total_comissao': comissao,
+        'gb_saldo_disponivel': comissao
+    }
+    alterados = {campo: delta for campo, delta in deltas.items() if delta}
+    
+    for _ in range(AFILIADOS_CONTADORES_TENTATIVAS):
+        response = supabase.table('gb_afiliados').select(', '.join(deltas)).eq('gb_id', afiliado_id).execute()
+        if not response.data:
+            return False
+        if not alterados:
+            return True
+        
+        atual = response.data[0]
+        query = supabase.table('gb_afiliados').update({
+            campo: round((atual[campo] or 0) + delta, 2) for campo, delta in alterados.items()
+        }).eq('gb_id', afiliado_id)
+        for campo in alterados:
+            query = query.is_(campo, 'null') if atual[campo] is None else query.eq(campo, atual[campo])
+        
+        # Sem linhas afetadas: outro processo alterou os contadores entre a leitura e a gravação
+        if query.execute().data:
+            return True
+    
+    raise RuntimeError(f"Contadores do afiliado {afiliado_id} alterados concorrentemente, tente novamente")
+
+def incrementar_contadores_afiliado(afiliado_id, clicks=0, vendas=0, comissao=0.0):
+    """Soma deltas aos contadores do afiliado de forma atômica; retorna se o afiliado existe"""
+    supabase = obter_supabase()
+    if supabase:
+        try:
+            # Função gb_incrementar_afiliado (supabase_funcoes.sql): col = col + delta no banco
+            response = supabase.rpc('gb_incrementar_afiliado', {
+                'p_afiliado_id': afiliado_id,
+                'p_clicks': clicks,
+                'p_vendas': vendas,
+                'p_comissao': comissao
+            }).execute()
+            return bool(response.data)
+        except ERROS_RESPOSTA_SUPABASE as e:
+            # Só a ausência da função justifica a contingência. Timeouts e disjuntor aberto sobem
+            # para quem chamou: a RPC pode ter sido aplicada e repetir os deltas duplicaria saldo.
+            if getattr(e, 'code', None) not in ('PGRST202', '42883'):
+                raise
+            log_error("incrementar_contadores_afiliado_rpc", e, {"afiliado_id": afiliado_id})
+        
+        return incrementar_contadores_afiliado_condicional(supabase, afiliado_id, clicks, vendas, comissao)
+    else:
+        with afiliados_contadores_lock:
+            for afiliado in memory_storage['afiliados']:
+                if afiliado.get('id') == afiliado_id:
+                    afiliado['total_clicks'] = afiliado.get('total_clicks', 0) + clicks
+                    afiliado['total_vendas'] = afiliado.get('total_vendas', 0) + vendas
+                    afiliado['total_comissao'] = afiliado.get('total_comissao', 0) + comissao
+                    afiliado['saldo_disponivel'] = afiliado.get('saldo_disponivel', 0) + comissao
+                    return True
+        return False
+
+# Cliques de afiliados ficam em um buffer e são gravados periodicamente por uma thread de
+# fundo: um insert com todos os cliques e uma atualização de contador por afiliado.
+CLIQUES_INTERVALO = float(os.getenv('CLIQUES_INTERVALO', '5'))
+CLIQUES_BUFFER_MAXIMO = int(os.getenv('CLIQUES_BUFFER_MAXIMO', '50000'))
+AFILIADOS_CODIGO_TTL = int(os.getenv('AFILIADOS_CODIGO_TTL', '300'))
+cliques_buffer = []
+cliques_lock = threading.Lock()
+cliques_stats = {'registrados': 0, 'gravados': 0, 'descartados': 0, 'falhas_insert': 0, 'falhas_contador': 0}
+cliques_contadores_pendentes = {}
+cliques_gravador = {'thread': None, 'pid': None}
+afiliados_por_codigo = {}
+
+def resolver_afiliados_por_codigo(codigos):
+    """Obtém o id dos afiliados ativos pelos códigos, usando cache com TTL"""
+    agora = time.monotonic()
+    resultado = {}
+    faltantes = []
+    
+    for codigo in set(codigos):
+        item = afiliados_por_codigo.get(codigo)
+        if item and item[1] > agora:
+            resultado[codigo] = item[0]
+        else:
+            faltantes.append(codigo)
+    
+    if faltantes:
+        encontrados = {a['gb_codigo']: a['gb_id'] for a in buscar_por_valores(
+            'gb_afiliados', 'gb_codigo', faltantes, campos='gb_id, gb_codigo, gb_status'
+        ) if a.get('gb_status') == 'ativo'}
+        
+        for codigo in faltantes:
+            # Códigos inexistentes também ficam em cache para não repetir a consulta
+            afiliados_por_codigo[codigo] = (encontrados.get(codigo), agora + AFILIADOS_CODIGO_TTL)
+            resultado[codigo] = encontrados.get(codigo)
+    
+    return resultado
+
+def registrar_clique_afiliado(codigo):
+    """Guarda um clique no buffer para gravação em lote"""
+    clique = {
+        'codigo': codigo,
+        'gb_ip_visitor': request.remote_addr or 'unknown',
+        'gb_user_agent': request.headers.get('User-Agent', '')[:500],
+        'gb_referrer': request.headers.get('Referer', '')[:500]
+    }
+    
+    with cliques_lock:
+        if len(cliques_buffer) >= CLIQUES_BUFFER_MAXIMO:
+            cliques_stats['descartados'] += 1
+            return
+        cliques_buffer.append(clique)
+        cliques_stats['registrados'] += 1
+    
+    iniciar_thread_fundo(cliques_gravador, gravador_cliques_loop, 'gravador-cliques')
+
+def devolver_cliques_buffer(lote):
+    """Devolve ao início do buffer os cliques não gravados, respeitando o limite"""
+    with cliques_lock:
+        devolvidos = lote[:max(CLIQUES_BUFFER_MAXIMO - len(cliques_buffer), 0)]
+        cliques_buffer[:0] = devolvidos
+        cliques_stats['descartados'] += len(lote) - len(devolvidos)
+
+@atexit.register
+def descarregar_cliques():
+    """Grava os cliques acumulados no buffer"""
+    supabase = obter_supabase()
+    with cliques_lock:
+        lote = cliques_buffer[:]
+        cliques_buffer.clear()
+        pendentes = dict(cliques_contadores_pendentes)
+        cliques_contadores_pendentes.clear()
+    
+    if not supabase:
+        devolver_cliques_buffer(lote)
+        return
+    
+    cliques_por_afiliado = {}
+    if lote:
+        try:
+            ids = resolver_afiliados_por_codigo(c['codigo'] for c in lote)
+            registros = []
+            
+            for clique in lote:
+                afiliado_id = ids.get(clique['codigo'])
+                if afiliado_id:
+                    registro = {campo: valor for campo, valor in clique.items() if campo != 'codigo'}
+                    registro['gb_afiliado_id'] = afiliado_id
+                    registros.append(registro)
+                    cliques_por_afiliado[afiliado_id] = cliques_por_afiliado.get(afiliado_id, 0) + 1
+            
+            if registros:
+                supabase.table('gb_afiliado_clicks').insert(registros).execute()
+            
+            cliques_stats['gravados'] += len(registros)
+            log_info("descarregar_cliques", f"{len(registros)} clique(s) gravado(s) para {len(cliques_por_afiliado)} afiliado(s)")
+        except Exception as e:
+            # Nada foi gravado: os cliques voltam ao buffer para a próxima rodada
+            cliques_stats['falhas_insert'] += len(lote)
+            devolver_cliques_buffer(lote)
+            cliques_por_afiliado = {}
+            log_error("descarregar_cliques", e, {"cliques": len(lote)})
+    
+    for afiliado_id, quantidade in pendentes.items():
+        cliques_por_afiliado[afiliado_id] = cliques_por_afiliado.get(afiliado_id, 0) + quantidade
+    
+    # Um incremento agregado por afiliado; os que falharem ficam pendentes para a próxima rodada
+    for afiliado_id, quantidade in cliques_por_afiliado.items():
+        try:
+            incrementar_contadores_afiliado(afiliado_id, clicks=quantidade)
+        except Exception as e:
+            cliques_stats['falhas_contador'] += quantidade
+            with cliques_lock:
+                cliques_contadores_pendentes[afiliado_id] = cliques_contadores_pendentes.get(afiliado_id, 0) + quantidade
+            log_error("descarregar_cliques_contador", e, {"afiliado_id": afiliado_id, "cliques": quantidade})
+
+def gravador_cliques_loop():
+    """Thread de fundo que grava o buffer de cliques a cada intervalo"""
+    while True:
+        time.sleep(CLIQUES_INTERVALO)
+        descarregar_cliques()
+
 def processar_comissao_afiliado(afiliado_id, valor_venda, venda_id):
     """Processa comissão do afiliado"""
+    supabase = obter_supabase()
     try:
         if not afiliado_id:
             return
@@ -347,23 +1739,9 @@ def processar_comissao_afiliado(afiliado_id, valor_venda, venda_id):
         
         if supabase:
             try:
-                # Buscar afiliado
-                afiliado_response = supabase.table('gb_afiliados').select('*').eq('gb_id', afiliado_id).execute()
-                if not afiliado_response.data:
-                    return
-                    
-                afiliado = afiliado_response.data[0]
-                
                 # Atualizar estatísticas do afiliado
-                novo_total_vendas = (afiliado.get('gb_total_vendas', 0) or 0) + 1
-                nova_comissao_total = (afiliado.get('gb_total_comissao', 0) or 0) + comissao
-                novo_saldo = (afiliado.get('gb_saldo_disponivel', 0) or 0) + comissao
-                
-                supabase.table('gb_afiliados').update({
-                    'gb_total_vendas': novo_total_vendas,
-                    'gb_total_comissao': nova_comissao_total,
-                    'gb_saldo_disponivel': novo_saldo
-                }).eq('gb_id', afiliado_id).execute()
+                if not incrementar_contadores_afiliado(afiliado_id, vendas=1, comissao=comissao):
+                    return
                 
                 # Registrar venda do afiliado
                 supabase.table('gb_afiliado_vendas').insert({
@@ -377,36 +1755,94 @@ def processar_comissao_afiliado(afiliado_id, valor_venda, venda_id):
                         f"Comissão processada: Afiliado {afiliado_id} - R$ {comissao:.2f}")
                         
             except Exception as e:
-                log_error("processar_comissao_afiliado", e)
+                log_error("processar_comissao_afiliado", e, {"afiliado_id": afiliado_id, "venda_id": venda_id, "comissao": comissao})
         else:
             # Processar em memória
-            for afiliado in memory_storage['afiliados']:
-                if afiliado.get('id') == afiliado_id:
-                    afiliado['total_vendas'] = afiliado.get('total_vendas', 0) + 1
-                    afiliado['total_comissao'] = afiliado.get('total_comissao', 0) + comissao
-                    afiliado['saldo_disponivel'] = afiliado.get('saldo_disponivel', 0) + comissao
-                    
-                    memory_storage['afiliado_vendas'].append({
-                        'id': len(memory_storage['afiliado_vendas']) + 1,
-                        'afiliado_id': afiliado_id,
-                        'venda_id': venda_id,
-                        'comissao': comissao,
-                        'status': 'aprovada',
-                        'data_venda': datetime.now().isoformat()
-                    })
-                    
-                    log_info("processar_comissao_afiliado", 
-                            f"Comissão processada em memória: Afiliado {afiliado_id} - R$ {comissao:.2f}")
-                    break
+            if incrementar_contadores_afiliado(afiliado_id, vendas=1, comissao=comissao):
+                memory_storage['afiliado_vendas'].append({
+                    'id': len(memory_storage['afiliado_vendas']) + 1,
+                    'afiliado_id': afiliado_id,
+                    'venda_id': venda_id,
+                    'comissao': comissao,
+                    'status': 'aprovada',
+                    'data_venda': datetime.now().isoformat()
+                })
+                
+                log_info("processar_comissao_afiliado", 
+                        f"Comissão processada em memória: Afiliado {afiliado_id} - R$ {comissao:.2f}")
                     
     except Exception as e:
         log_error("processar_comissao_afiliado", e)
 
 # ========== ROTAS PRINCIPAIS ==========
 
+# index.html fica em memória já comprimido (gzip e, se disponível, brotli). A variante é
+# escolhida pelo Accept-Encoding e o ETag permite responder 304; o arquivo é recarregado
+# quando a data de modificação muda.
+INDEX_HTML_CAMINHO = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'index.html')
+pagina_index = {'mtime': None, 'etag': None, 'variantes': {}}
+pagina_index_lock = threading.Lock()
+
+def carregar_pagina_index():
+    """Lê e comprime o index.html se ele mudou desde a última carga"""
+    mtime = os.stat(INDEX_HTML_CAMINHO).st_mtime_ns
+    if pagina_index['mtime'] == mtime:
+        return pagina_index
+    
+    with pagina_index_lock:
+        if pagina_index['mtime'] == mtime:
+            return pagina_index
+        
+        with open(INDEX_HTML_CAMINHO, 'rb') as arquivo:
+            conteudo = arquivo.read()
+        
+        variantes = {
+            'identity': conteudo,
+            'gzip': gzip.compress(conteudo, compresslevel=9, mtime=0)
+        }
+        if brotli_available:
+            variantes['br'] = brotli.compress(conteudo, quality=11)
+        
+        pagina_index.update({
+            'mtime': mtime,
+            'etag': hashlib.sha256(conteudo).hexdigest()[:20],
+            'variantes': variantes
+        })
+        return pagina_index
+
+def responder_pagina_index():
+    """Resposta do index.html na melhor codificação aceita pelo cliente, ou 304"""
+    pagina = carregar_pagina_index()
+    variantes = pagina['variantes']
+    
+    codificacao = 'identity'
+    for candidata in ('br', 'gzip'):
+        if candidata in variantes and request.accept_encodings[candidata]:
+            codificacao = candidata
+            break
+    
+    etag = f"{pagina['etag']}-{codificacao}"
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = Response(variantes[codificacao], mimetype='text/html')
+        if codificacao != 'identity':
+            response.headers['Content-Encoding'] = codificacao
+    
+    response.set_etag(etag)
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+try:
+    carregar_pagina_index()
+except OSError as e:
+    print(f"❌ Erro ao carregar index.html: {str(e)}")
+
 @app.route('/')
 def index():
     """Serve a página principal"""
+    supabase = obter_supabase()
     try:
         # Registrar código de afiliado se presente
         ref_code = request.args.get('ref')
@@ -414,30 +1850,12 @@ def index():
             session['ref_code'] = ref_code
             log_info("index", f"Código de afiliado registrado: {ref_code}")
             
-            # Registrar clique do afiliado
+            # Registrar clique do afiliado (gravado em lote em segundo plano)
             if supabase:
-                try:
-                    afiliado = supabase.table('gb_afiliados').select('gb_id').eq('gb_codigo', ref_code).execute()
-                    if afiliado.data:
-                        supabase.table('gb_afiliado_clicks').insert({
-                            'gb_afiliado_id': afiliado.data[0]['gb_id'],
-                            'gb_ip_visitor': request.remote_addr or 'unknown',
-                            'gb_user_agent': request.headers.get('User-Agent', '')[:500],
-                            'gb_referrer': request.headers.get('Referer', '')[:500]
-                        }).execute()
-                        
-                        # Incrementar contador
-                        current_clicks = supabase.table('gb_afiliados').select('gb_total_clicks').eq('gb_id', afiliado.data[0]['gb_id']).execute()
-                        new_clicks = (current_clicks.data[0]['gb_total_clicks'] or 0) + 1 if current_clicks.data else 1
-                        
-                        supabase.table('gb_afiliados').update({
-                            'gb_total_clicks': new_clicks
-                        }).eq('gb_id', afiliado.data[0]['gb_id']).execute()
-                except:
-                    pass
-        
-        # Servir o arquivo index.html
-        return send_from_directory('.', 'index.html')
+                registrar_clique_afiliado(ref_code)
+        
+        # Servir o index.html em memória (comprimido e com ETag)
+        return responder_pagina_index()
     except Exception as e:
         log_error("index", e)
         return f"""
@@ -462,9 +1880,19 @@ def index():
         </html>
         """, 500
 
+@app.before_request
+def verificar_conexao_supabase():
+    """Sem Supabase e sem fallback em memória, recusa a requisição em vez de dividir os dados"""
+    if SUPABASE_FALLBACK_MEMORIA or not supabase_available or obter_supabase():
+        return None
+    if request.path == '/health' or request.path.startswith('/static'):
+        return None
+    return jsonify({'error': 'Serviço temporariamente indisponível'}), 503
+
 @app.route('/health')
 def health_check():
     """Health check detalhado"""
+    supabase = obter_supabase()
     try:
         hoje = date.today().isoformat()
         
@@ -521,6 +1949,14 @@ def health_check():
                 'qrcode': qrcode_available,
                 'reportlab': reportlab_available
             },
+            'cache_configuracao': estatisticas_cache_configuracao(),
+            'fila_logs': dict(logs_fila_stats, pendentes=logs_fila.qsize()),
+            'logs_suprimidos': dict(logs_controle['suprimidos']),
+            'cliques_afiliados': dict(cliques_stats, pendentes=len(cliques_buffer), contadores_pendentes=sum(cliques_contadores_pendentes.values())),
+            'mercadopago_http': mp_http_cliente.estatisticas() if mp_http_cliente else {},
+            'disjuntores': estatisticas_disjuntores(),
+            'conexao_supabase': estatisticas_conexao_supabase(),
+            'cache_qr_code': estatisticas_cache_qr_code(),
             'games': ['raspa_brasil', '2para1000'],
             'features': [
                 'login_clientes',
@@ -556,6 +1992,7 @@ def health_check():
 @app.route('/cliente/cadastrar', methods=['POST'])
 def cliente_cadastrar():
     """Cadastra novo cliente"""
+    supabase = obter_supabase()
     try:
         data = sanitizar_dados_entrada(request.json)
         
@@ -648,6 +2085,7 @@ def cliente_cadastrar():
 @app.route('/cliente/login', methods=['POST'])
 def cliente_login():
     """Login do cliente por CPF"""
+    supabase = obter_supabase()
     try:
         data = sanitizar_dados_entrada(request.json)
         cpf = data.get('cpf', '').replace('.', '').replace('-', '').replace(' ', '')
@@ -754,6 +2192,7 @@ def cliente_verificar_login():
 @app.route('/cliente/minhas_raspadinhas')
 def cliente_minhas_raspadinhas():
     """Obtém raspadinhas do cliente logado"""
+    supabase = obter_supabase()
     try:
         if not validar_session_cliente():
             return jsonify({'erro': 'Não autorizado'}), 401
@@ -770,12 +2209,14 @@ def cliente_minhas_raspadinhas():
                     'gb_data_criacao', desc=True
                 ).execute()
                 
+                # Buscar raspadinhas de todas as vendas de uma vez
+                raspadinhas_por_venda = agrupar_por(buscar_por_valores(
+                    'gb_cliente_raspadinhas', 'gb_venda_id',
+                    [venda['gb_id'] for venda in (vendas.data or [])],
+                    ordem='gb_numero_raspadinha'
+                ), 'gb_venda_id')
+                
                 for venda in (vendas.data or []):
-                    # Buscar raspadinhas desta venda
-                    rasp_response = supabase.table('gb_cliente_raspadinhas').select('*').eq(
-                        'gb_venda_id', venda['gb_id']
-                    ).order('gb_numero_raspadinha').execute()
-                    
                     raspadinhas.append({
                         'venda_id': venda['gb_id'],
                         'payment_id': venda['gb_payment_id'],
@@ -788,7 +2229,7 @@ def cliente_minhas_raspadinhas():
                             'premio': r.get('gb_premio'),
                             'codigo': r.get('gb_codigo_premio'),
                             'data_raspagem': r.get('gb_data_raspagem')
-                        } for r in (rasp_response.data or [])]
+                        } for r in raspadinhas_por_venda.get(venda['gb_id'], [])]
                     })
                     
             except Exception as e:
@@ -797,17 +2238,14 @@ def cliente_minhas_raspadinhas():
             # Buscar em memória
             for venda in memory_storage['vendas']:
                 if venda.get('cliente_id') == cliente_id and venda.get('tipo_jogo') == 'raspa_brasil' and venda.get('status') == 'completed':
-                    rasp_list = []
-                    for rasp in memory_storage['cliente_raspadinhas']:
-                        if rasp.get('venda_id') == venda['id']:
-                            rasp_list.append({
-                                'id': rasp['id'],
-                                'numero': rasp['numero_raspadinha'],
-                                'status': rasp['status'],
-                                'premio': rasp.get('premio'),
-                                'codigo': rasp.get('codigo_premio'),
-                                'data_raspagem': rasp.get('data_raspagem')
-                            })
+                    rasp_list = [{
+                        'id': rasp['id'],
+                        'numero': rasp['numero_raspadinha'],
+                        'status': rasp['status'],
+                        'premio': rasp.get('premio'),
+                        'codigo': rasp.get('codigo_premio'),
+                        'data_raspagem': rasp.get('data_raspagem')
+                    } for rasp in memory_indices['cliente_raspadinhas'].get(venda['id'], [])]
                     
                     raspadinhas.append({
                         'venda_id': venda['id'],
@@ -826,6 +2264,7 @@ def cliente_minhas_raspadinhas():
 @app.route('/cliente/meus_bilhetes')
 def cliente_meus_bilhetes():
     """Obtém bilhetes do cliente logado"""
+    supabase = obter_supabase()
     try:
         if not validar_session_cliente():
             return jsonify({'erro': 'Não autorizado'}), 401
@@ -842,12 +2281,14 @@ def cliente_meus_bilhetes():
                     'gb_data_criacao', desc=True
                 ).execute()
                 
+                # Buscar bilhetes de todas as vendas de uma vez
+                bilhetes_por_venda = agrupar_por(buscar_por_valores(
+                    'gb_cliente_bilhetes', 'gb_venda_id',
+                    [venda['gb_id'] for venda in (vendas.data or [])],
+                    ordem='gb_numero_bilhete'
+                ), 'gb_venda_id')
+                
                 for venda in (vendas.data or []):
-                    # Buscar bilhetes desta venda
-                    bilh_response = supabase.table('gb_cliente_bilhetes').select('*').eq(
-                        'gb_venda_id', venda['gb_id']
-                    ).order('gb_numero_bilhete').execute()
-                    
                     bilhetes.append({
                         'venda_id': venda['gb_id'],
                         'payment_id': venda['gb_payment_id'],
@@ -859,7 +2300,7 @@ def cliente_meus_bilhetes():
                             'data_sorteio': b['gb_data_sorteio'],
                             'status': b['gb_status'],
                             'premio_ganho': b.get('gb_premio_ganho')
-                        } for b in (bilh_response.data or [])]
+                        } for b in bilhetes_por_venda.get(venda['gb_id'], [])]
                     })
                     
             except Exception as e:
@@ -868,16 +2309,16 @@ def cliente_meus_bilhetes():
             # Buscar em memória
             for venda in memory_storage['vendas']:
                 if venda.get('cliente_id') == cliente_id and venda.get('tipo_jogo') == '2para1000' and venda.get('status') == 'completed':
-                    bilh_list = []
-                    for bilh in memory_storage['cliente_bilhetes']:
-                        if bilh.get('venda_id') == venda['id']:
-                            bilh_list.append({
-                                'id': bilh['id'],
-                                'numero': bilh['numero_bilhete'],
-                                'data_sorteio': bilh['data_sorteio'],
-                                'status': bilh['status'],
-                                'premio_ganho': bilh.get('premio_ganho')
-                            })
+                    bilh_list = [{
+                        'id': bilh['id'],
+                        'numero': bilh['numero_bilhete'],
+                        'data_sorteio': bilh['data_sorteio'],
+                        'status': bilh['status'],
+                        'premio_ganho': bilh.get('premio_ganho')
+                    } for bilh in sorted(
+                        memory_indices['cliente_bilhetes'].get(venda['id'], []),
+                        key=lambda b: b['numero_bilhete']
+                    )]
                     
                     bilhetes.append({
                         'venda_id': venda['id'],
@@ -895,9 +2336,94 @@ def cliente_meus_bilhetes():
 
 # ========== ROTAS DE PAGAMENTO ==========
 
+# Estado de cada pagamento guardado no servidor e indexado pelo payment_id. A fonte é a própria
+# venda (gb_vendas ou memória); o cache evita reler o banco a cada consulta e o cookie da
+# sessão fica apenas com a identidade do cliente.
+ESTADO_PAGAMENTOS_MAXIMO = 10000
+estado_pagamentos = OrderedDict()
+estado_pagamentos_lock = threading.Lock()
+
+def registrar_estado_pagamento(estado):
+    """Guarda o estado do pagamento, descartando os mais antigos"""
+    payment_id = str(estado['payment_id'])
+    with estado_pagamentos_lock:
+        estado_pagamentos[payment_id] = estado
+        estado_pagamentos.move_to_end(payment_id)
+        while len(estado_pagamentos) > ESTADO_PAGAMENTOS_MAXIMO:
+            estado_pagamentos.popitem(last=False)
+
+def converter_data_criacao(valor):
+    """Converte a data de criação da venda em timestamp (0 se ausente ou inválida)"""
+    try:
+        return datetime.fromisoformat(str(valor).replace('Z', '+00:00')).timestamp()
+    except (TypeError, ValueError):
+        return 0
+
+def obter_estado_pagamento(payment_id):
+    """Obtém o estado do pagamento do cache ou, na falta dele, da venda correspondente"""
+    supabase = obter_supabase()
+    payment_id = str(payment_id)
+    with estado_pagamentos_lock:
+        estado = estado_pagamentos.get(payment_id)
+        if estado:
+            estado_pagamentos.move_to_end(payment_id)
+            return dict(estado)
+    
+    estado = None
+    if supabase:
+        try:
+            response = supabase.table('gb_vendas').select(
+                'gb_id, gb_cliente_id, gb_afiliado_id, gb_tipo_jogo, gb_quantidade, gb_valor_total, gb_data_criacao'
+            ).eq('gb_payment_id', payment_id).limit(1).execute()
+            
+            if response.data:
+                venda = response.data[0]
+                estado = {
+                    'payment_id': payment_id,
+                    'venda_id': venda['gb_id'],
+                    'cliente_id': venda['gb_cliente_id'],
+                    'afiliado_id': venda.get('gb_afiliado_id'),
+                    'tipo_jogo': venda['gb_tipo_jogo'],
+                    'quantidade': venda['gb_quantidade'],
+                    'valor_total': float(venda['gb_valor_total'] or 0),
+                    'criado_em': converter_data_criacao(venda.get('gb_data_criacao'))
+                }
+        except Exception as e:
+            log_error("obter_estado_pagamento", e, {"payment_id": payment_id})
+    else:
+        venda = next((v for v in memory_storage['vendas'] if v.get('payment_id') == payment_id), None)
+        if venda:
+            estado = {
+                'payment_id': payment_id,
+                'venda_id': venda['id'],
+                'cliente_id': venda['cliente_id'],
+                'afiliado_id': venda.get('afiliado_id'),
+                'tipo_jogo': venda['tipo_jogo'],
+                'quantidade': venda['quantidade'],
+                'valor_total': venda['valor_total'],
+                'criado_em': converter_data_criacao(venda.get('data_criacao'))
+            }
+    
+    if not estado:
+        return None
+    
+    registrar_estado_pagamento(estado)
+    return dict(estado)
+
+def obter_estado_pagamento_cliente(payment_id, cliente_id):
+    """Obtém o estado do pagamento apenas se ele pertencer ao cliente informado"""
+    if not payment_id:
+        return None
+    estado = obter_estado_pagamento(payment_id)
+    if not estado or estado['cliente_id'] != cliente_id:
+        return None
+    return estado
+
 @app.route('/create_payment', methods=['POST'])
 def create_payment():
     """Cria pagamento PIX - Real ou Simulado"""
+    supabase = obter_supabase()
+    reserva_atual = None
     try:
         data = sanitizar_dados_entrada(request.json)
         quantidade = data.get('quantidade', 1)
@@ -923,13 +2449,17 @@ def create_payment():
 
         log_info("create_payment", f"Criando pagamento: {game_type} - {quantidade} unidades - R$ {total:.2f} - Cliente ID: {cliente_id}")
 
-        # Verificar disponibilidade (apenas para Raspa Brasil)
+        # Reservar estoque (apenas para Raspa Brasil)
+        reserva_id = None
         if game_type == 'raspa_brasil':
-            vendidas = obter_total_vendas('raspa_brasil')
-            if vendidas + quantidade > TOTAL_RASPADINHAS:
+            reserva_id = uuid.uuid4().hex
+            reservado, disponiveis = reservar_estoque(reserva_id, quantidade)
+            if reservado:
+                reserva_atual = reserva_id
+            else:
                 return jsonify({
                     'error': 'Raspadinhas esgotadas',
-                    'details': f'Restam apenas {TOTAL_RASPADINHAS - vendidas} disponíveis'
+                    'details': f'Restam apenas {disponiveis} disponíveis'
                 }), 400
 
         # Buscar afiliado se houver código
@@ -994,24 +2524,29 @@ def create_payment():
                     raise Exception("Erro na resposta do Mercado Pago")
                     
             except Exception as e:
+                # Com o Mercado Pago configurado nunca cair no pagamento simulado (que se aprova
+                # sozinho): falha ou disjuntor aberto deixam o pagamento indisponível
                 log_error("create_payment_real", e)
-                payment_id = None
+                if reserva_atual:
+                    cancelar_reserva(reserva_atual)
+                    reserva_atual = None
+                return jsonify({
+                    'error': 'Pagamento indisponível',
+                    'details': 'Tente novamente em alguns instantes'
+                }), 503
 
-        # Fallback para pagamento simulado
+        # Pagamento simulado (somente sem Mercado Pago configurado)
         if not payment_id:
             payment_id = gerar_payment_id()
             qr_data = gerar_qr_code_simulado({'amount': total, 'description': descricao})
             log_info("create_payment", f"Pagamento simulado criado: {payment_id}")
 
-        # Salvar sessão
-        session['payment_id'] = payment_id
-        session['quantidade'] = quantidade
-        session['game_type'] = game_type
-        session['payment_created_at'] = datetime.now().isoformat()
-        if afiliado_id:
-            session['afiliado_id'] = afiliado_id
+        if reserva_id:
+            renomear_reserva(reserva_id, payment_id)
+            reserva_atual = payment_id
 
         # Salvar no banco/memória
+        venda_id = None
         venda_data = {
             'payment_id': payment_id,
             'cliente_id': cliente_id,
@@ -1049,43 +2584,41 @@ def create_payment():
                 
                 if response.data:
                     venda_id = response.data[0]['gb_id']
-                    session['venda_id'] = venda_id
                     
                     # Criar registros de raspadinhas ou bilhetes
                     if game_type == 'raspa_brasil':
-                        quantidade_real = 12 if quantidade == 10 else quantidade
-                        for i in range(quantidade_real):
-                            supabase.table('gb_cliente_raspadinhas').insert({
-                                'gb_cliente_id': cliente_id,
-                                'gb_venda_id': venda_id,
-                                'gb_numero_raspadinha': i + 1,
-                                'gb_status': 'disponivel'
-                            }).execute()
+                        criar_raspadinhas_venda(cliente_id, venda_id, quantidade)
                     
                     log_info("create_payment", f"Venda salva no Supabase: {payment_id}")
+                else:
+                    cancelar_reserva(payment_id)
                     
             except Exception as e:
+                cancelar_reserva(payment_id)
                 log_error("create_payment_save", e, {"payment_id": payment_id})
         else:
             # Salvar em memória
             venda_data['id'] = len(memory_storage['vendas']) + 1
             memory_storage['vendas'].append(venda_data)
-            session['venda_id'] = venda_data['id']
+            venda_id = venda_data['id']
             
             # Criar registros de raspadinhas ou bilhetes
             if game_type == 'raspa_brasil':
-                quantidade_real = 12 if quantidade == 10 else quantidade
-                for i in range(quantidade_real):
-                    memory_storage['cliente_raspadinhas'].append({
-                        'id': len(memory_storage['cliente_raspadinhas']) + 1,
-                        'cliente_id': cliente_id,
-                        'venda_id': venda_data['id'],
-                        'numero_raspadinha': i + 1,
-                        'status': 'disponivel'
-                    })
+                criar_raspadinhas_venda(cliente_id, venda_data['id'], quantidade)
             
             log_info("create_payment", f"Venda salva em memória: {payment_id}")
 
+        registrar_estado_pagamento({
+            'payment_id': payment_id,
+            'venda_id': venda_id,
+            'cliente_id': cliente_id,
+            'afiliado_id': afiliado_id,
+            'tipo_jogo': game_type,
+            'quantidade': quantidade,
+            'valor_total': total,
+            'criado_em': time.time()
+        })
+
         return jsonify({
             'id': payment_id,
             'qr_code': qr_data.get('qr_code', ''),
@@ -1095,9 +2628,89 @@ def create_payment():
         })
 
     except Exception as e:
+        if reserva_atual:
+            cancelar_reserva(reserva_atual)
         log_error("create_payment", e)
         return jsonify({'error': 'Erro interno do servidor'}), 500
 
+# Status dos pagamentos reais guardado localmente. É alimentado pelo webhook, pela primeira
+# consulta ao Mercado Pago e por um reconciliador de fundo que confere as vendas aprovadas no
+# banco em lote; o Mercado Pago só é consultado de novo quando o registro fica velho.
+PAGAMENTO_STATUS_MAX_IDADE = float(os.getenv('PAGAMENTO_STATUS_MAX_IDADE', '60'))
+PAGAMENTO_RECONCILIAR_INTERVALO = float(os.getenv('PAGAMENTO_RECONCILIAR_INTERVALO', '3'))
+PAGAMENTO_STATUS_RETENCAO = 3600
+PAGAMENTO_STATUS_FINAIS = ('approved', 'rejected', 'cancelled', 'refunded', 'charged_back')
+pagamentos_status = {}
+pagamentos_status_lock = threading.Lock()
+pagamentos_reconciliador = {'thread': None, 'pid': None}
+
+def registrar_status_pagamento(payment_id, dados):
+    """Guarda o status de um pagamento consultado no Mercado Pago"""
+    agora = time.monotonic()
+    with pagamentos_status_lock:
+        item = pagamentos_status.setdefault(str(payment_id), {'criado_em': agora})
+        item['dados'] = dados
+        item['atualizado_em'] = agora
+    iniciar_thread_fundo(pagamentos_reconciliador, reconciliador_pagamentos_loop, 'reconciliador-pagamentos')
+
+def obter_status_pagamento(payment_id):
+    """Obtém o status local do pagamento, se existir e não estiver velho (status finais não envelhecem)"""
+    with pagamentos_status_lock:
+        item = pagamentos_status.get(str(payment_id))
+        if not item:
+            return None
+        if item['dados']['status'] not in PAGAMENTO_STATUS_FINAIS and time.monotonic() - item['atualizado_em'] > PAGAMENTO_STATUS_MAX_IDADE:
+            return None
+        return dict(item['dados'])
+
+def consultar_pagamento_mercadopago(payment_id):
+    """Consulta o pagamento no Mercado Pago e atualiza o status local"""
+    payment_response = sdk.payment().get(str(payment_id))
+    if payment_response["status"] != 200:
+        return None
+    
+    payment = payment_response["response"]
+    dados = {
+        'status': payment['status'],
+        'amount': payment.get('transaction_amount', 0),
+        'description': payment.get('description', ''),
+        'date_created': payment.get('date_created', ''),
+        'date_approved': payment.get('date_approved', '')
+    }
+    registrar_status_pagamento(payment_id, dados)
+    return dados
+
+def reconciliar_pagamentos():
+    """Marca como aprovados os pagamentos ainda não finalizados cuja venda já foi concluída no banco"""
+    supabase = obter_supabase()
+    agora = time.monotonic()
+    with pagamentos_status_lock:
+        for payment_id in [p for p, item in pagamentos_status.items() if agora - item['criado_em'] > PAGAMENTO_STATUS_RETENCAO]:
+            del pagamentos_status[payment_id]
+        pendentes = [p for p, item in pagamentos_status.items() if item['dados']['status'] not in PAGAMENTO_STATUS_FINAIS]
+    
+    if not pendentes or not supabase:
+        return
+    
+    concluidas = [v['gb_payment_id'] for v in buscar_por_valores(
+        'gb_vendas', 'gb_payment_id', pendentes, campos='gb_payment_id, gb_status'
+    ) if v['gb_status'] == 'completed']
+    
+    with pagamentos_status_lock:
+        for payment_id in concluidas:
+            item = pagamentos_status.get(payment_id)
+            if item and item['dados']['status'] not in PAGAMENTO_STATUS_FINAIS:
+                item['dados']['status'] = 'approved'
+
+def reconciliador_pagamentos_loop():
+    """Thread de fundo que reconcilia periodicamente os pagamentos pendentes"""
+    while True:
+        time.sleep(PAGAMENTO_RECONCILIAR_INTERVALO)
+        try:
+            reconciliar_pagamentos()
+        except Exception as e:
+            log_error("reconciliar_pagamentos", e)
+
 @app.route('/check_payment/<payment_id>')
 def check_payment(payment_id):
     """Verifica status do pagamento"""
@@ -1105,66 +2718,74 @@ def check_payment(payment_id):
         if not payment_id or payment_id in ['undefined', 'null', '']:
             return jsonify({'error': 'Payment ID inválido'}), 400
 
-        log_info("check_payment", f"Verificando pagamento: {payment_id}")
+        log_debug("check_payment", f"Verificando pagamento: {payment_id}")
 
-        # Verificar pagamento real primeiro
-        if sdk:
+        # Pagamento real: só o Mercado Pago aprova. Se a consulta falhar (erro, timeout ou
+        # disjuntor aberto) o pagamento continua pendente - nunca cai na aprovação simulada.
+        if not pagamento_simulado(payment_id):
+            if not sdk:
+                return jsonify({'status': 'pending'})
             try:
-                payment_response = sdk.payment().get(str(payment_id))
-                if payment_response["status"] == 200:
-                    payment = payment_response["response"]
-                    status = payment['status']
-                    
+                # Status local primeiro; o Mercado Pago só é consultado se faltar ou estiver velho
+                dados = obter_status_pagamento(payment_id) or consultar_pagamento_mercadopago(payment_id)
+                if dados:
                     # Processar aprovação
-                    if status == 'approved':
+                    if dados['status'] == 'approved':
                         processar_pagamento_aprovado(payment_id)
                     
-                    return jsonify({
-                        'status': status,
-                        'amount': payment.get('transaction_amount', 0),
-                        'description': payment.get('description', ''),
-                        'date_created': payment.get('date_created', ''),
-                        'date_approved': payment.get('date_approved', '')
-                    })
+                    return jsonify(dados)
             except Exception as e:
                 log_error("check_payment_real", e, {"payment_id": payment_id})
+            return jsonify({'status': 'pending'})
 
-        # Pagamento simulado - aprovar automaticamente após 3 segundos
-        payment_key = f'payment_processed_{payment_id}'
-        if payment_key not in session:
-            payment_created = session.get('payment_created_at')
-            if payment_created:
-                created_time = datetime.fromisoformat(payment_created)
-                if (datetime.now() - created_time).total_seconds() > 3:
-                    # Simular aprovação
-                    session[payment_key] = True
-                    processar_pagamento_aprovado(payment_id)
-                    log_info("check_payment", f"Pagamento simulado aprovado: {payment_id}")
-                    return jsonify({'status': 'approved'})
-                else:
-                    return jsonify({'status': 'pending'})
-            else:
-                return jsonify({'status': 'pending'})
-        else:
+        # Pagamento simulado - aprovar automaticamente após 3 segundos. Com o Mercado Pago
+        # configurado nenhum id simulado é aprovado.
+        if sdk:
+            return jsonify({'status': 'pending'})
+        
+        if pagamento_ja_processado(payment_id):
+            return jsonify({'status': 'approved'})
+        
+        estado = obter_estado_pagamento_cliente(payment_id, session.get('cliente_id'))
+        if estado and time.time() - estado['criado_em'] > 3:
+            # Simular aprovação
+            processar_pagamento_aprovado(payment_id)
+            log_info("check_payment", f"Pagamento simulado aprovado: {payment_id}")
             return jsonify({'status': 'approved'})
+        
+        return jsonify({'status': 'pending'})
 
     except Exception as e:
         log_error("check_payment", e, {"payment_id": payment_id})
         return jsonify({'error': str(e)}), 500
 
+# Pagamentos cuja aprovação já foi tratada neste processo (consultas seguintes são só leitura)
+PAGAMENTOS_PROCESSADOS_MAXIMO = 10000
+pagamentos_processados = OrderedDict()
+pagamentos_lock = threading.Lock()
+
+def pagamento_ja_processado(payment_id):
+    """Verifica se a aprovação do pagamento já foi tratada neste processo"""
+    with pagamentos_lock:
+        return str(payment_id) in pagamentos_processados
+
+def marcar_pagamento_processado(payment_id):
+    """Registra o pagamento como processado, descartando os mais antigos"""
+    with pagamentos_lock:
+        pagamentos_processados[str(payment_id)] = True
+        pagamentos_processados.move_to_end(str(payment_id))
+        while len(pagamentos_processados) > PAGAMENTOS_PROCESSADOS_MAXIMO:
+            pagamentos_processados.popitem(last=False)
+
 def processar_pagamento_aprovado(payment_id):
-    """Processa pagamento aprovado"""
+    """Processa pagamento aprovado - os efeitos colaterais rodam uma única vez por pagamento"""
+    supabase = obter_supabase()
     try:
-        game_type = session.get('game_type', 'raspa_brasil')
-        afiliado_id = session.get('afiliado_id')
-        quantidade = session.get('quantidade', 0)
-        venda_id = session.get('venda_id')
-        
-        # Calcular valor total
-        preco_unitario = PRECO_RASPADINHA_RB if game_type == 'raspa_brasil' else PRECO_BILHETE_ML
-        valor_total = quantidade * preco_unitario
+        if pagamento_ja_processado(payment_id):
+            return False
         
-        # Atualizar no banco
+        # Transição condicional pending -> completed: só quem muda o status segue adiante.
+        # Os dados da venda vêm da própria linha atualizada, sem depender da sessão do cliente.
         if supabase:
             try:
                 update_data = {
@@ -1172,39 +2793,75 @@ def processar_pagamento_aprovado(payment_id):
                     'gb_data_aprovacao': datetime.now().isoformat()
                 }
                 
-                supabase.table('gb_vendas').update(update_data).eq('gb_payment_id', str(payment_id)).execute()
+                response = supabase.table('gb_vendas').update(update_data).eq(
+                    'gb_payment_id', str(payment_id)
+                ).eq('gb_status', 'pending').execute()
+                
+                if not response.data:
+                    marcar_pagamento_processado(payment_id)
+                    return False
+                
+                venda = response.data[0]
+                afiliado_id = venda.get('gb_afiliado_id')
+                venda_id = venda['gb_id']
+                valor_total = float(venda['gb_valor_total'] or 0)
+                
                 log_info("processar_pagamento_aprovado", f"Status atualizado no Supabase: {payment_id}")
                 
             except Exception as e:
                 log_error("processar_pagamento_aprovado", e, {"payment_id": payment_id})
+                return False
         else:
             # Atualizar em memória
-            for venda in memory_storage['vendas']:
-                if venda.get('payment_id') == payment_id:
+            with pagamentos_lock:
+                venda = next((v for v in memory_storage['vendas'] if v.get('payment_id') == payment_id), None)
+                if not venda or venda.get('status') != 'pending':
+                    venda = None
+                else:
                     venda['status'] = 'completed'
                     venda['data_aprovacao'] = datetime.now().isoformat()
-                    log_info("processar_pagamento_aprovado", f"Status atualizado em memória: {payment_id}")
-                    break
+                    registrar_venda_aprovada_memoria(venda)
+            
+            if not venda:
+                marcar_pagamento_processado(payment_id)
+                return False
+            
+            afiliado_id = venda.get('afiliado_id')
+            venda_id = venda['id']
+            valor_total = venda['valor_total']
+            
+            log_info("processar_pagamento_aprovado", f"Status atualizado em memória: {payment_id}")
+        
+        marcar_pagamento_processado(payment_id)
+        confirmar_reserva(payment_id)
         
         # Processar comissão do afiliado
         if afiliado_id and venda_id:
             processar_comissao_afiliado(afiliado_id, valor_total, venda_id)
+        
+        return True
 
     except Exception as e:
         log_error("processar_pagamento_aprovado", e, {"payment_id": payment_id})
+        return False
 
 @app.route('/webhook/mercadopago', methods=['POST'])
 def webhook_mercadopago():
     """Webhook do Mercado Pago"""
     try:
         data = request.json
-        log_info("webhook_mercadopago", f"Webhook recebido: {data}")
+        log_debug("webhook_mercadopago", f"Webhook recebido: {data}")
         
         if data.get('type') == 'payment':
             payment_id = data.get('data', {}).get('id')
             if payment_id:
                 log_info("webhook_mercadopago", f"Processando payment: {payment_id}")
-                processar_pagamento_aprovado(str(payment_id))
+                if sdk:
+                    dados = consultar_pagamento_mercadopago(payment_id)
+                    if dados and dados['status'] == 'approved':
+                        processar_pagamento_aprovado(str(payment_id))
+                else:
+                    processar_pagamento_aprovado(str(payment_id))
         
         return jsonify({'status': 'ok'}), 200
     except Exception as e:
@@ -1216,6 +2873,7 @@ def webhook_mercadopago():
 @app.route('/raspar', methods=['POST'])
 def raspar():
     """Processa raspagem"""
+    supabase = obter_supabase()
     try:
         if not validar_session_cliente():
             return jsonify({'erro': 'Faça login para raspar'}), 401
@@ -1351,6 +3009,7 @@ def raspar():
 @app.route('/salvar_ganhador', methods=['POST'])
 def salvar_ganhador():
     """Salva dados do ganhador"""
+    supabase = obter_supabase()
     try:
         if not validar_session_cliente():
             return jsonify({'sucesso': False, 'erro': 'Não autorizado'}), 401
@@ -1431,13 +3090,13 @@ def salvar_ganhador():
 @app.route('/enviar_bilhete', methods=['POST'])
 def enviar_bilhete():
     """Salva dados do cliente e seus bilhetes do 2 para 1000"""
+    supabase = obter_supabase()
     try:
         if not validar_session_cliente():
             return jsonify({'sucesso': False, 'erro': 'Não autorizado'}), 401
         
         data = sanitizar_dados_entrada(request.json)
         cliente_id = session.get('cliente_id')
-        venda_id = session.get('venda_id')
 
         campos_obrigatorios = ['nome', 'telefone', 'chave_pix']
         for campo in campos_obrigatorios:
@@ -1451,9 +3110,10 @@ def enviar_bilhete():
         if len(data['telefone']) < 10:
             return jsonify({'sucesso': False, 'erro': 'Telefone inválido'})
 
-        payment_id = data.get('payment_id') or session.get('payment_id')
-        if not payment_id:
+        estado = obter_estado_pagamento_cliente(data.get('payment_id'), cliente_id)
+        if not estado:
             return jsonify({'sucesso': False, 'erro': 'Payment ID não encontrado'})
+        venda_id = estado['venda_id']
 
         # Atualizar dados do cliente
         if supabase:
@@ -1508,66 +3168,153 @@ def enviar_bilhete():
         log_error("enviar_bilhete", e)
         return jsonify({'sucesso': False, 'erro': 'Erro interno do servidor'})
 
+# A emissão dos bilhetes de uma venda é reivindicada marcando gb_bilhetes_emitidos de false
+# para true em um único update condicional; só quem recebe a linha de volta aloca as milhares,
+# mesmo com vários processos atendendo a mesma venda.
+bilhetes_lock = threading.Lock()
+
+def reivindicar_emissao_bilhetes(venda_id):
+    """Marca a venda como em emissão; retorna False se outro pedido já a reivindicou"""
+    supabase = obter_supabase()
+    if supabase:
+        resposta = supabase.table('gb_vendas').update({'gb_bilhetes_emitidos': True}).eq(
+            'gb_id', venda_id
+        ).eq('gb_status', 'completed').eq('gb_bilhetes_emitidos', False).execute()
+        return bool(resposta.data)
+    else:
+        with bilhetes_lock:
+            venda = next((v for v in memory_storage['vendas'] if v.get('id') == venda_id), None)
+            if not venda or venda.get('bilhetes_emitidos'):
+                return False
+            venda['bilhetes_emitidos'] = True
+            return True
+
+def liberar_emissao_bilhetes(venda_id):
+    """Desfaz a reivindicação quando nenhum bilhete da venda chegou a ser gravado"""
+    supabase = obter_supabase()
+    if supabase:
+        bilhetes = supabase.table('gb_cliente_bilhetes').select('gb_id').eq('gb_venda_id', venda_id).limit(1).execute()
+        if not bilhetes.data:
+            supabase.table('gb_vendas').update({'gb_bilhetes_emitidos': False}).eq('gb_id', venda_id).execute()
+    else:
+        with bilhetes_lock:
+            venda = next((v for v in memory_storage['vendas'] if v.get('id') == venda_id), None)
+            if venda and not memory_indices['cliente_bilhetes'].get(venda_id):
+                venda['bilhetes_emitidos'] = False
+
+def situacao_venda_bilhetes(venda_id):
+    """Situação da venda para emissão: nao_encontrada, pendente, emitidos ou liberada"""
+    supabase = obter_supabase()
+    if supabase:
+        venda = supabase.table('gb_vendas').select('gb_status, gb_tipo_jogo').eq('gb_id', venda_id).execute()
+        if not venda.data or venda.data[0]['gb_tipo_jogo'] != '2para1000':
+            return 'nao_encontrada'
+        if venda.data[0]['gb_status'] != 'completed':
+            return 'pendente'
+        bilhetes = supabase.table('gb_cliente_bilhetes').select('gb_id').eq('gb_venda_id', venda_id).limit(1).execute()
+        return 'emitidos' if bilhetes.data else 'liberada'
+    else:
+        venda = next((v for v in memory_storage['vendas'] if v.get('id') == venda_id), None)
+        if not venda or venda.get('tipo_jogo') != '2para1000':
+            return 'nao_encontrada'
+        if venda.get('status') != 'completed':
+            return 'pendente'
+        return 'emitidos' if memory_indices['cliente_bilhetes'].get(venda_id) else 'liberada'
+
+def emitir_bilhetes_venda(supabase, cliente_id, venda_id, quantidade):
+    """Aloca as milhares e grava os bilhetes de uma venda aprovada"""
+    hoje = date.today().isoformat()
+    
+    if supabase:
+        for tentativa in range(MILHARES_TENTATIVAS):
+            try:
+                bilhetes_gerados = alocar_milhares(hoje, quantidade)
+            except ValueError as e:
+                log_error("gerar_bilhetes_ml", e, {"quantidade": quantidade})
+                return jsonify({'erro': 'Não há milhares suficientes disponíveis para hoje'}), 400
+            
+            try:
+                # Gravar todos os bilhetes da venda de uma vez
+                supabase.table('gb_cliente_bilhetes').insert([{
+                    'gb_cliente_id': cliente_id,
+                    'gb_venda_id': venda_id,
+                    'gb_numero_bilhete': numero,
+                    'gb_data_sorteio': hoje,
+                    'gb_status': 'ativo'
+                } for numero in bilhetes_gerados]).execute()
+                
+                log_info("gerar_bilhetes_ml", f"Bilhetes gerados: {bilhetes_gerados}")
+                break
+                
+            except Exception as e:
+                # A lista local estava desatualizada (ou o estado é incerto): recarregar do banco
+                descartar_milhares(hoje)
+                if erro_conflito_unico(e) and tentativa + 1 < MILHARES_TENTATIVAS:
+                    log_info("gerar_bilhetes_ml", f"Milhar já vendida por outro processo, realocando (tentativa {tentativa + 1})")
+                    continue
+                log_error("gerar_bilhetes_ml", e)
+                return jsonify({'erro': 'Erro ao gerar bilhetes'}), 500
+    else:
+        try:
+            bilhetes_gerados = alocar_milhares(hoje, quantidade)
+        except ValueError as e:
+            log_error("gerar_bilhetes_ml", e, {"quantidade": quantidade})
+            return jsonify({'erro': 'Não há milhares suficientes disponíveis para hoje'}), 400
+        
+        # Gerar em memória
+        proximo_id = len(memory_storage['cliente_bilhetes']) + 1
+        registros = [{
+            'id': proximo_id + i,
+            'cliente_id': cliente_id,
+            'venda_id': venda_id,
+            'numero_bilhete': numero,
+            'data_sorteio': hoje,
+            'status': 'ativo'
+        } for i, numero in enumerate(bilhetes_gerados)]
+        
+        memory_storage['cliente_bilhetes'].extend(registros)
+        indexar_por_venda('cliente_bilhetes', registros)
+        
+        log_info("gerar_bilhetes_ml", f"Bilhetes gerados em memória: {bilhetes_gerados}")
+    
+    return jsonify({
+        'sucesso': True,
+        'bilhetes': bilhetes_gerados
+    })
+
 @app.route('/gerar_bilhetes_ml', methods=['POST'])
 def gerar_bilhetes_ml():
     """Gera bilhetes para o cliente após pagamento aprovado"""
+    supabase = obter_supabase()
     try:
         if not validar_session_cliente():
             return jsonify({'erro': 'Não autorizado'}), 401
         
-        venda_id = session.get('venda_id')
-        quantidade = session.get('quantidade', 0)
+        data = sanitizar_dados_entrada(request.json or {})
         cliente_id = session.get('cliente_id')
+        estado = obter_estado_pagamento_cliente(data.get('payment_id'), cliente_id)
+        venda_id = estado['venda_id'] if estado else None
+        quantidade = estado['quantidade'] if estado else 0
         
         if not venda_id or quantidade == 0:
             return jsonify({'erro': 'Dados de venda não encontrados'}), 400
         
-        bilhetes_gerados = []
-        hoje = date.today().isoformat()
-        
-        if supabase:
-            try:
-                # Gerar bilhetes únicos
-                for i in range(quantidade):
-                    numero = gerar_milhar()
-                    
-                    supabase.table('gb_cliente_bilhetes').insert({
-                        'gb_cliente_id': cliente_id,
-                        'gb_venda_id': venda_id,
-                        'gb_numero_bilhete': numero,
-                        'gb_data_sorteio': hoje,
-                        'gb_status': 'ativo'
-                    }).execute()
-                    
-                    bilhetes_gerados.append(numero)
-                
-                log_info("gerar_bilhetes_ml", f"Bilhetes gerados: {bilhetes_gerados}")
-                
-            except Exception as e:
-                log_error("gerar_bilhetes_ml", e)
-                return jsonify({'erro': 'Erro ao gerar bilhetes'}), 500
-        else:
-            # Gerar em memória
-            for i in range(quantidade):
-                numero = gerar_milhar()
-                
-                memory_storage['cliente_bilhetes'].append({
-                    'id': len(memory_storage['cliente_bilhetes']) + 1,
-                    'cliente_id': cliente_id,
-                    'venda_id': venda_id,
-                    'numero_bilhete': numero,
-                    'data_sorteio': hoje,
-                    'status': 'ativo'
-                })
-                
-                bilhetes_gerados.append(numero)
-            
-            log_info("gerar_bilhetes_ml", f"Bilhetes gerados em memória: {bilhetes_gerados}")
+        situacao = situacao_venda_bilhetes(venda_id)
+        if situacao == 'nao_encontrada':
+            return jsonify({'erro': 'Dados de venda não encontrados'}), 400
+        if situacao == 'pendente':
+            return jsonify({'erro': 'Pagamento ainda não aprovado'}), 400
+        if situacao == 'emitidos' or not reivindicar_emissao_bilhetes(venda_id):
+            return jsonify({'erro': 'Bilhetes já gerados para esta compra'}), 409
         
-        return jsonify({
-            'sucesso': True,
-            'bilhetes': bilhetes_gerados
-        })
+        resposta = None
+        try:
+            resposta = emitir_bilhetes_venda(supabase, cliente_id, venda_id, quantidade)
+            return resposta
+        finally:
+            # Respostas de erro voltam como (json, status): liberar a venda para nova tentativa
+            if resposta is None or isinstance(resposta, tuple):
+                liberar_emissao_bilhetes(venda_id)
         
     except Exception as e:
         log_error("gerar_bilhetes_ml", e)
@@ -1576,6 +3323,7 @@ def gerar_bilhetes_ml():
 @app.route('/resultado_sorteio')
 def resultado_sorteio():
     """Obtém resultado do sorteio do dia do 2 para 1000 - CORRIGIDO"""
+    supabase = obter_supabase()
     try:
         hoje = date.today().isoformat()
         valor_acumulado = obter_premio_acumulado()
@@ -1632,6 +3380,7 @@ def resultado_sorteio():
 @app.route('/ultimos_ganhadores')
 def ultimos_ganhadores():
     """Obtém últimos ganhadores do 2 para 1000"""
+    supabase = obter_supabase()
     try:
         ganhadores = []
         
@@ -1687,6 +3436,7 @@ def ultimos_ganhadores():
 @app.route('/cadastrar_afiliado', methods=['POST'])
 def cadastrar_afiliado():
     """Cadastra novo afiliado"""
+    supabase = obter_supabase()
     try:
         data = sanitizar_dados_entrada(request.json)
         
@@ -1823,6 +3573,7 @@ def cadastrar_afiliado():
 @app.route('/login_afiliado', methods=['POST'])
 def login_afiliado():
     """Login do afiliado por CPF"""
+    supabase = obter_supabase()
     try:
         data = sanitizar_dados_entrada(request.json)
         cpf = data.get('cpf', '').replace('.', '').replace('-', '').replace(' ', '')
@@ -1893,6 +3644,7 @@ def login_afiliado():
 @app.route('/click_afiliado', methods=['POST'])
 def click_afiliado():
     """Registra clique do afiliado"""
+    supabase = obter_supabase()
     try:
         data = sanitizar_dados_entrada(request.json)
         codigo = data.get('codigo')
@@ -1902,25 +3654,9 @@ def click_afiliado():
         
         if supabase:
             try:
-                # Buscar afiliado
-                afiliado = supabase.table('gb_afiliados').select('*').eq('gb_codigo', codigo).eq('gb_status', 'ativo').execute()
-                
-                if afiliado.data:
-                    afiliado_id = afiliado.data[0]['gb_id']
-                    
-                    # Registrar clique
-                    supabase.table('gb_afiliado_clicks').insert({
-                        'gb_afiliado_id': afiliado_id,
-                        'gb_ip_visitor': request.remote_addr or 'unknown',
-                        'gb_user_agent': request.headers.get('User-Agent', '')[:500],
-                        'gb_referrer': request.headers.get('Referer', '')[:500]
-                    }).execute()
-                    
-                    # Incrementar contador
-                    current_clicks = afiliado.data[0].get('gb_total_clicks', 0) or 0
-                    supabase.table('gb_afiliados').update({
-                        'gb_total_clicks': current_clicks + 1
-                    }).eq('gb_id', afiliado_id).execute()
+                # Validar o código (em cache) e registrar o clique no buffer
+                if resolver_afiliados_por_codigo([codigo]).get(codigo):
+                    registrar_clique_afiliado(codigo)
                     
                     log_info("click_afiliado", f"Clique registrado para afiliado: {codigo}")
                     return jsonify({'sucesso': True})
@@ -1931,7 +3667,7 @@ def click_afiliado():
             # Registrar em memória
             for afiliado in memory_storage['afiliados']:
                 if afiliado.get('codigo') == codigo and afiliado.get('status') == 'ativo':
-                    afiliado['total_clicks'] = afiliado.get('total_clicks', 0) + 1
+                    incrementar_contadores_afiliado(afiliado['id'], clicks=1)
                     
                     memory_storage['afiliado_clicks'].append({
                         'id': len(memory_storage['afiliado_clicks']) + 1,
@@ -1954,6 +3690,7 @@ def click_afiliado():
 @app.route('/atualizar_pix_afiliado', methods=['POST'])
 def atualizar_pix_afiliado():
     """Atualiza chave PIX do afiliado"""
+    supabase = obter_supabase()
     try:
         data = sanitizar_dados_entrada(request.json)
         codigo = data.get('codigo')
@@ -2001,6 +3738,7 @@ def atualizar_pix_afiliado():
 @app.route('/solicitar_saque_afiliado', methods=['POST'])
 def solicitar_saque_afiliado():
     """Solicita saque do afiliado"""
+    supabase = obter_supabase()
     try:
         data = sanitizar_dados_entrada(request.json)
         codigo = data.get('codigo')
@@ -2116,6 +3854,7 @@ def admin_login():
 @app.route('/admin/stats')
 def admin_stats():
     """Estatísticas do sistema unificado"""
+    supabase = obter_supabase()
     try:
         if not validar_session_admin():
             return jsonify({'error': 'Acesso negado'}), 403
@@ -2139,6 +3878,12 @@ def admin_stats():
             'total_clientes': 0
         }
         
+        if game in ['raspa_brasil', 'both']:
+            estoque = obter_estoque_rb()
+            stats['vendidas'] = estoque['vendidas']
+            stats['reservadas'] = estoque['reservadas']
+            stats['restantes'] = estoque['disponiveis']
+        
         if supabase:
             try:
                 # Total de clientes
@@ -2146,10 +3891,6 @@ def admin_stats():
                 stats['total_clientes'] = len(clientes.data or [])
                 
                 if game in ['raspa_brasil', 'both']:
-                    vendidas_rb = obter_total_vendas('raspa_brasil')
-                    stats['vendidas'] = vendidas_rb
-                    stats['restantes'] = TOTAL_RASPADINHAS - vendidas_rb
-                    
                     ganhadores_rb = supabase.table('gb_ganhadores').select('gb_id').eq('gb_tipo_jogo', 'raspa_brasil').execute()
                     stats['ganhadores'] = len(ganhadores_rb.data or [])
                     
@@ -2276,6 +4017,7 @@ def admin_editar_premio_ml():
 @app.route('/admin/sortear', methods=['POST'])
 def admin_sortear():
     """Realiza sorteio do 2 para 1000 - CORRIGIDO para estrutura atual"""
+    supabase = obter_supabase()
     try:
         if not validar_session_admin():
             return jsonify({'sucesso': False, 'erro': 'Acesso negado'}), 403
@@ -2460,6 +4202,7 @@ def admin_sortear():
 @app.route('/admin/afiliados')
 def admin_afiliados():
     """Obtém lista de afiliados para o admin"""
+    supabase = obter_supabase()
     try:
         if not validar_session_admin():
             return jsonify({'error': 'Acesso negado'}), 403
@@ -2518,6 +4261,7 @@ def admin_afiliados():
 @app.route('/admin/saques/<status>')
 def admin_saques(status):
     """Obtém lista de saques para o admin"""
+    supabase = obter_supabase()
     try:
         if not validar_session_admin():
             return jsonify({'error': 'Acesso negado'}), 403
@@ -2536,11 +4280,17 @@ def admin_saques(status):
                 
                 response = query.execute()
                 
+                # Buscar nome e código de todos os afiliados envolvidos de uma vez
+                afiliados = {a['gb_id']: a for a in buscar_por_valores(
+                    'gb_afiliados', 'gb_id',
+                    [s.get('gb_afiliado_id') for s in (response.data or [])],
+                    campos='gb_id, gb_nome, gb_codigo'
+                )}
+                
                 for s in (response.data or []):
-                    # Buscar nome do afiliado
-                    afiliado = supabase.table('gb_afiliados').select('gb_nome, gb_codigo').eq('gb_id', s.get('gb_afiliado_id')).execute()
-                    afiliado_nome = afiliado.data[0]['gb_nome'] if afiliado.data else 'Desconhecido'
-                    afiliado_codigo = afiliado.data[0]['gb_codigo'] if afiliado.data else ''
+                    afiliado = afiliados.get(s.get('gb_afiliado_id'))
+                    afiliado_nome = afiliado['gb_nome'] if afiliado else 'Desconhecido'
+                    afiliado_codigo = afiliado['gb_codigo'] if afiliado else ''
                     
                     saques.append({
                         'id': s['gb_id'],
@@ -2582,6 +4332,7 @@ def admin_saques(status):
 @app.route('/admin/marcar_saque_pago', methods=['POST'])
 def admin_marcar_saque_pago():
     """Marca saque como pago"""
+    supabase = obter_supabase()
     try:
         if not validar_session_admin():
             return jsonify({'sucesso': False, 'erro': 'Acesso negado'}), 403
@@ -2627,6 +4378,7 @@ def admin_marcar_saque_pago():
 @app.route('/admin/bilhetes/<data_filtro>')
 def admin_bilhetes(data_filtro):
     """Obtém bilhetes vendidos para o admin"""
+    supabase = obter_supabase()
     try:
         if not validar_session_admin():
             return jsonify({'error': 'Acesso negado'}), 403
@@ -2636,26 +4388,28 @@ def admin_bilhetes(data_filtro):
         if supabase:
             try:
                 # Buscar vendas do dia
-                vendas = supabase.table('gb_vendas').select('*').gte(
+                vendas = buscar_paginado(lambda: supabase.table('gb_vendas').select('*').gte(
                     'gb_data_criacao', data_filtro + ' 00:00:00'
                 ).lt('gb_data_criacao', data_filtro + ' 23:59:59').eq(
                     'gb_tipo_jogo', '2para1000'
-                ).eq('gb_status', 'completed').execute()
+                ).eq('gb_status', 'completed').order('gb_id'))
                 
-                for venda in (vendas.data or []):
-                    # Buscar bilhetes da venda
-                    bilhetes_venda = supabase.table('gb_cliente_bilhetes').select('gb_numero_bilhete').eq(
-                        'gb_venda_id', venda['gb_id']
-                    ).execute()
-                    
-                    numeros_bilhetes = [b['gb_numero_bilhete'] for b in (bilhetes_venda.data or [])]
-                    
-                    # Buscar dados do cliente
-                    cliente = supabase.table('gb_clientes').select('gb_nome, gb_telefone, gb_chave_pix').eq(
-                        'gb_id', venda['gb_cliente_id']
-                    ).execute()
-                    
-                    cliente_data = cliente.data[0] if cliente.data else {}
+                # Buscar bilhetes e clientes de todas as vendas de uma vez
+                bilhetes_por_venda = agrupar_por(buscar_por_valores(
+                    'gb_cliente_bilhetes', 'gb_venda_id',
+                    [venda['gb_id'] for venda in vendas],
+                    campos='gb_venda_id, gb_numero_bilhete'
+                ), 'gb_venda_id')
+                
+                clientes = {c['gb_id']: c for c in buscar_por_valores(
+                    'gb_clientes', 'gb_id',
+                    [venda['gb_cliente_id'] for venda in vendas],
+                    campos='gb_id, gb_nome, gb_telefone, gb_chave_pix'
+                )}
+                
+                for venda in vendas:
+                    numeros_bilhetes = [b['gb_numero_bilhete'] for b in bilhetes_por_venda.get(venda['gb_id'], [])]
+                    cliente_data = clientes.get(venda['gb_cliente_id'], {})
                     
                     bilhetes.append({
                         'payment_id': venda['gb_payment_id'],
@@ -2670,23 +4424,17 @@ def admin_bilhetes(data_filtro):
                 log_error("admin_bilhetes", e)
         else:
             # Buscar em memória
+            clientes = {c.get('id'): c for c in memory_storage['clientes']}
+            
             for venda in memory_storage['vendas']:
                 if (venda.get('data_criacao', '')[:10] == data_filtro and 
                     venda.get('tipo_jogo') == '2para1000' and 
                     venda.get('status') == 'completed'):
                     
-                    # Buscar bilhetes
-                    numeros_bilhetes = []
-                    for bilhete in memory_storage['cliente_bilhetes']:
-                        if bilhete.get('venda_id') == venda['id']:
-                            numeros_bilhetes.append(bilhete['numero_bilhete'])
-                    
-                    # Buscar cliente
-                    cliente_data = {}
-                    for cliente in memory_storage['clientes']:
-                        if cliente.get('id') == venda['cliente_id']:
-                            cliente_data = cliente
-                            break
+                    numeros_bilhetes = [
+                        b['numero_bilhete'] for b in memory_indices['cliente_bilhetes'].get(venda['id'], [])
+                    ]
+                    cliente_data = clientes.get(venda['cliente_id'], {})
                     
                     bilhetes.append({
                         'payment_id': venda['payment_id'],
@@ -2707,6 +4455,7 @@ def admin_bilhetes(data_filtro):
 @app.route('/admin/raspadinhas/<data_filtro>')
 def admin_raspadinhas(data_filtro):
     """Obtém raspadinhas vendidas para o admin"""
+    supabase = obter_supabase()
     try:
         if not validar_session_admin():
             return jsonify({'error': 'Acesso negado'}), 403
@@ -2721,22 +4470,21 @@ def admin_raspadinhas(data_filtro):
         if supabase:
             try:
                 # Buscar vendas do dia
-                vendas_response = supabase.table('gb_vendas').select('*').gte(
+                vendas_dia = buscar_paginado(lambda: supabase.table('gb_vendas').select('*').gte(
                     'gb_data_criacao', data_filtro + ' 00:00:00'
                 ).lt('gb_data_criacao', data_filtro + ' 23:59:59').eq(
                     'gb_tipo_jogo', 'raspa_brasil'
-                ).order('gb_data_criacao', desc=True).execute()
-                
-                for venda in (vendas_response.data or []):
-                    # Buscar dados do afiliado se houver
-                    afiliado_nome = ''
-                    if venda.get('gb_afiliado_id'):
-                        afiliado = supabase.table('gb_afiliados').select('gb_nome').eq(
-                            'gb_id', venda['gb_afiliado_id']
-                        ).execute()
-                        if afiliado.data:
-                            afiliado_nome = afiliado.data[0]['gb_nome']
-                    
+                ).order('gb_data_criacao.desc,gb_id', desc=True))
+                
+                # Buscar nomes dos afiliados distintos de uma vez
+                nomes_afiliados = {a['gb_id']: a['gb_nome'] for a in buscar_por_valores(
+                    'gb_afiliados', 'gb_id',
+                    [venda.get('gb_afiliado_id') for venda in vendas_dia],
+                    campos='gb_id, gb_nome'
+                )}
+                
+                for venda in vendas_dia:
+                    afiliado_nome = nomes_afiliados.get(venda.get('gb_afiliado_id'), '')
                     raspadinhas_usadas = venda.get('gb_raspadinhas_usadas', 0) or 0
                     
                     vendas.append({
@@ -2760,18 +4508,13 @@ def admin_raspadinhas(data_filtro):
                 log_error("admin_raspadinhas", e)
         else:
             # Buscar em memória
+            nomes_afiliados = {a.get('id'): a['nome'] for a in memory_storage['afiliados']}
+            
             for venda in memory_storage['vendas']:
                 if (venda.get('data_criacao', '')[:10] == data_filtro and 
                     venda.get('tipo_jogo') == 'raspa_brasil'):
                     
-                    # Buscar afiliado
-                    afiliado_nome = ''
-                    if venda.get('afiliado_id'):
-                        for afiliado in memory_storage['afiliados']:
-                            if afiliado.get('id') == venda['afiliado_id']:
-                                afiliado_nome = afiliado['nome']
-                                break
-                    
+                    afiliado_nome = nomes_afiliados.get(venda.get('afiliado_id'), '')
                     raspadinhas_usadas = venda.get('raspadinhas_usadas', 0)
                     
                     vendas.append({
@@ -2804,6 +4547,7 @@ def admin_raspadinhas(data_filtro):
 @app.route('/admin/ganhadores/<game>')
 def admin_ganhadores(game):
     """Obtém lista de ganhadores para o admin"""
+    supabase = obter_supabase()
     try:
         if not validar_session_admin():
             return jsonify({'error': 'Acesso negado'}), 403
@@ -2886,6 +4630,7 @@ def admin_ganhadores(game):
 @app.route('/admin/marcar_ganhador_pago', methods=['POST'])
 def admin_marcar_ganhador_pago():
     """Marca ganhador como pago"""
+    supabase = obter_supabase()
     try:
         if not validar_session_admin():
             return jsonify({'sucesso': False, 'erro': 'Acesso negado'}), 403
@@ -2931,16 +4676,17 @@ def admin_marcar_ganhador_pago():
 @app.route('/admin/adicionar_ganhador', methods=['POST'])
 def admin_adicionar_ganhador():
     """Adiciona ganhador manual - VERSÃO DEBUG COMPLETA"""
+    supabase = obter_supabase()
     try:
         if not validar_session_admin():
             return jsonify({'sucesso': False, 'erro': 'Acesso negado'}), 403
         
         # DEBUG: Log dos dados RAW recebidos
         raw_data = request.json
-        log_info("admin_adicionar_ganhador", f"🔍 DADOS RAW RECEBIDOS: {raw_data}")
+        log_debug("admin_adicionar_ganhador", f"🔍 DADOS RAW RECEBIDOS: {raw_data}")
         
         data = sanitizar_dados_entrada(raw_data)
-        log_info("admin_adicionar_ganhador", f"🔍 DADOS APÓS SANITIZAÇÃO: {data}")
+        log_debug("admin_adicionar_ganhador", f"🔍 DADOS APÓS SANITIZAÇÃO: {data}")
         
         jogo = data.get('jogo')
         nome = data.get('nome', '').strip()
@@ -2951,7 +4697,7 @@ def admin_adicionar_ganhador():
         
         # DEBUG ESPECÍFICO PARA MILHAR
         milhar_raw = data.get('milhar')
-        log_info("admin_adicionar_ganhador", f"🔍 MILHAR RAW: '{milhar_raw}' (tipo: {type(milhar_raw)})")
+        log_debug("admin_adicionar_ganhador", f"🔍 MILHAR RAW: '{milhar_raw}' (tipo: {type(milhar_raw)})")
         
         if jogo == '2para1000':
             # Tentar diferentes formas de obter a milhar
@@ -2961,18 +4707,18 @@ def admin_adicionar_ganhador():
             for key in possible_keys:
                 if key in data and data[key] is not None:
                     milhar = str(data[key]).strip()
-                    log_info("admin_adicionar_ganhador", f"🔍 MILHAR ENCONTRADA EM '{key}': '{milhar}'")
+                    log_debug("admin_adicionar_ganhador", f"🔍 MILHAR ENCONTRADA EM '{key}': '{milhar}'")
                     break
             
             if milhar is None:
                 log_error("admin_adicionar_ganhador", f"❌ MILHAR NÃO ENCONTRADA. Chaves disponíveis: {list(data.keys())}")
                 return jsonify({'sucesso': False, 'erro': 'Campo milhar não encontrado nos dados enviados'})
                 
-            log_info("admin_adicionar_ganhador", f"🔍 MILHAR FINAL: '{milhar}' (len: {len(milhar)})")
+            log_debug("admin_adicionar_ganhador", f"🔍 MILHAR FINAL: '{milhar}' (len: {len(milhar)})")
         else:
             milhar = None
         
-        log_info("admin_adicionar_ganhador", f"📝 DADOS FINAIS - Jogo: '{jogo}', Nome: '{nome}', Valor: '{valor}', Milhar: '{milhar}'")
+        log_debug("admin_adicionar_ganhador", f"📝 DADOS FINAIS - Jogo: '{jogo}', Nome: '{nome}', Valor: '{valor}', Milhar: '{milhar}'")
         
         # Validações básicas
         if not all([jogo, nome, valor, chave_pix]):
@@ -2988,14 +4734,14 @@ def admin_adicionar_ganhador():
         
         # VALIDAÇÃO ESPECÍFICA PARA 2PARA1000 COM DEBUG
         if jogo == '2para1000':
-            log_info("admin_adicionar_ganhador", f"🎯 VALIDANDO 2PARA1000 - Milhar: '{milhar}'")
+            log_debug("admin_adicionar_ganhador", f"🎯 VALIDANDO 2PARA1000 - Milhar: '{milhar}'")
             
             if not milhar:
                 return jsonify({'sucesso': False, 'erro': 'Campo milhar é obrigatório para 2para1000'})
             
             # Remover todos os espaços e caracteres especiais
             milhar_clean = ''.join(c for c in milhar if c.isdigit())
-            log_info("admin_adicionar_ganhador", f"🔧 MILHAR LIMPA: '{milhar_clean}' (original: '{milhar}')")
+            log_debug("admin_adicionar_ganhador", f"🔧 MILHAR LIMPA: '{milhar_clean}' (original: '{milhar}')")
             
             if len(milhar_clean) != 4:
                 return jsonify({'sucesso': False, 'erro': f'Milhar deve ter 4 dígitos. Recebido: "{milhar}" (limpo: "{milhar_clean}", {len(milhar_clean)} dígitos)'})
@@ -3005,7 +4751,7 @@ def admin_adicionar_ganhador():
             
             # Usar a milhar limpa
             milhar = milhar_clean
-            log_info("admin_adicionar_ganhador", f"✅ MILHAR VALIDADA: '{milhar}'")
+            log_debug("admin_adicionar_ganhador", f"✅ MILHAR VALIDADA: '{milhar}'")
             
             # Verificar duplicata
             if supabase:
@@ -3039,18 +4785,18 @@ def admin_adicionar_ganhador():
                 # CAMPOS ESPECÍFICOS POR JOGO
                 if jogo == 'raspa_brasil':
                     db_data['gb_codigo_premio'] = codigo
-                    log_info("admin_adicionar_ganhador", f"🎫 Raspa Brasil - Código: {codigo}")
+                    log_debug("admin_adicionar_ganhador", f"🎫 Raspa Brasil - Código: {codigo}")
                 else:  # 2para1000
                     db_data['gb_bilhete_premiado'] = milhar
-                    log_info("admin_adicionar_ganhador", f"🎯 2para1000 - Milhar: {milhar}")
+                    log_debug("admin_adicionar_ganhador", f"🎯 2para1000 - Milhar: {milhar}")
                 
-                log_info("admin_adicionar_ganhador", f"📊 DADOS PARA INSERÇÃO: {db_data}")
+                log_debug("admin_adicionar_ganhador", f"📊 DADOS PARA INSERÇÃO: {db_data}")
                 
                 # INSERIR NO BANCO DE DADOS
                 response = supabase.table('gb_ganhadores').insert(db_data).execute()
                 
-                log_info("admin_adicionar_ganhador", f"📤 RESPOSTA SUPABASE: status={response.status_code if hasattr(response, 'status_code') else 'N/A'}")
-                log_info("admin_adicionar_ganhador", f"📤 DADOS RESPOSTA: {response.data}")
+                log_debug("admin_adicionar_ganhador", f"📤 RESPOSTA SUPABASE: status={response.status_code if hasattr(response, 'status_code') else 'N/A'}")
+                log_debug("admin_adicionar_ganhador", f"📤 DADOS RESPOSTA: {response.data}")
                 
                 if response.data and len(response.data) > 0:
                     ganhador_id = response.data[0]['gb_id']
@@ -3106,15 +4852,87 @@ def admin_adicionar_ganhador():
         log_error("admin_adicionar_ganhador", f"❌ TRACEBACK COMPLETO: {traceback.format_exc()}")
         return jsonify({'sucesso': False, 'erro': f'Erro interno: {str(e)}'})
 
+@app.route('/admin/logs')
+def admin_logs():
+    """Consulta paginada dos logs do sistema, com filtro por operação e tipo"""
+    supabase = obter_supabase()
+    try:
+        if not validar_session_admin():
+            return jsonify({'error': 'Acesso negado'}), 403
+        
+        operacao = request.args.get('operacao')
+        tipo = request.args.get('tipo')
+        
+        try:
+            pagina = max(int(request.args.get('pagina', 1)), 1)
+            por_pagina = min(max(int(request.args.get('por_pagina', 50)), 1), 200)
+        except ValueError:
+            return jsonify({'error': 'Paginação inválida'}), 400
+        
+        inicio = (pagina - 1) * por_pagina
+        logs = []
+        
+        if supabase:
+            try:
+                query = supabase.table('gb_logs_sistema').select('*').order('gb_id', desc=True)
+                
+                if operacao:
+                    query = query.eq('gb_operacao', operacao)
+                if tipo:
+                    query = query.eq('gb_tipo', tipo)
+                
+                response = query.range(inicio, inicio + por_pagina - 1).execute()
+                
+                for l in (response.data or []):
+                    logs.append({
+                        'id': l['gb_id'],
+                        'operacao': l['gb_operacao'],
+                        'tipo': l['gb_tipo'],
+                        'mensagem': l['gb_mensagem'],
+                        'dados_extras': l.get('gb_dados_extras'),
+                        'timestamp': l.get('gb_data_criacao')
+                    })
+                    
+            except Exception as e:
+                log_error("admin_logs", e)
+        else:
+            logs = [dict(l) for l in consultar_logs_memoria(operacao, tipo, inicio, por_pagina)]
+        
+        return jsonify({
+            'logs': logs,
+            'pagina': pagina,
+            'por_pagina': por_pagina
+        })
+        
+    except Exception as e:
+        log_error("admin_logs", e)
+        return jsonify({'logs': []})
+
+# Maior período aceito na série diária do relatório
+RELATORIO_MAXIMO_DIAS = 366
+
 @app.route('/admin/relatorio_vendas')
 def admin_relatorio_vendas():
-    """Gera relatório de vendas"""
+    """Gera relatório de vendas a partir do consolidado diário"""
     try:
         if not validar_session_admin():
             return jsonify({'error': 'Acesso negado'}), 403
         
         hoje = date.today()
-        vendas_7_dias = []
+        hoje_str = hoje.isoformat()
+        
+        # Período opcional da série diária (padrão: últimos 7 dias)
+        try:
+            data_fim = date.fromisoformat(request.args.get('fim') or hoje_str).isoformat()
+            data_inicio = date.fromisoformat(
+                request.args.get('inicio') or (date.fromisoformat(data_fim) - timedelta(days=6)).isoformat()
+            ).isoformat()
+        except ValueError:
+            return jsonify({'error': 'Data inválida, use o formato AAAA-MM-DD'}), 400
+        
+        dias_periodo = (date.fromisoformat(data_fim) - date.fromisoformat(data_inicio)).days + 1
+        if dias_periodo < 1 or dias_periodo > RELATORIO_MAXIMO_DIAS:
+            return jsonify({'error': f'Período inválido: use até {RELATORIO_MAXIMO_DIAS} dias, com início antes do fim'}), 400
         
         relatorio = {
             'vendas_rb': 0,
@@ -3124,83 +4942,39 @@ def admin_relatorio_vendas():
             'vendas_7_dias': []
         }
         
-        if supabase:
-            try:
-                # Total vendas RB
-                vendas_rb = supabase.table('gb_vendas').select('gb_quantidade').eq(
-                    'gb_tipo_jogo', 'raspa_brasil'
-                ).eq('gb_status', 'completed').execute()
-                relatorio['vendas_rb'] = sum(v['gb_quantidade'] for v in (vendas_rb.data or []))
+        try:
+            # Uma única leitura do consolidado: totais gerais, hoje e série do período
+            totais_por_dia = {}
+            
+            for linha in obter_vendas_diarias():
+                if linha['tipo_jogo'] == 'raspa_brasil':
+                    relatorio['vendas_rb'] += linha['quantidade']
+                elif linha['tipo_jogo'] == '2para1000':
+                    relatorio['vendas_ml'] += linha['quantidade']
                 
-                # Total vendas ML
-                vendas_ml = supabase.table('gb_vendas').select('gb_quantidade').eq(
-                    'gb_tipo_jogo', '2para1000'
-                ).eq('gb_status', 'completed').execute()
-                relatorio['vendas_ml'] = sum(v['gb_quantidade'] for v in (vendas_ml.data or []))
-                
-                # Receita total
-                vendas_todas = supabase.table('gb_vendas').select('gb_valor_total').eq('gb_status', 'completed').execute()
-                relatorio['receita_total'] = sum(v['gb_valor_total'] for v in (vendas_todas.data or []))
-                
-                # Vendas de hoje
-                hoje_str = hoje.isoformat()
-                vendas_hoje = supabase.table('gb_vendas').select('gb_quantidade').gte(
-                    'gb_data_criacao', hoje_str + ' 00:00:00'
-                ).lt('gb_data_criacao', hoje_str + ' 23:59:59').eq('gb_status', 'completed').execute()
-                relatorio['vendas_hoje'] = sum(v['gb_quantidade'] for v in (vendas_hoje.data or []))
-                
-                # Vendas dos últimos 7 dias
-                for i in range(7):
-                    dia = hoje - timedelta(days=i)
-                    dia_str = dia.isoformat()
-                    
-                    vendas_dia = supabase.table('gb_vendas').select('gb_quantidade').gte(
-                        'gb_data_criacao', dia_str + ' 00:00:00'
-                    ).lt('gb_data_criacao', dia_str + ' 23:59:59').eq('gb_status', 'completed').execute()
-                    
-                    total_dia = sum(v['gb_quantidade'] for v in (vendas_dia.data or []))
-                    
-                    vendas_7_dias.append({
-                        'data': dia_str,
-                        'total': total_dia
-                    })
+                relatorio['receita_total'] += linha['receita']
                 
-                relatorio['vendas_7_dias'] = list(reversed(vendas_7_dias))
+                if linha['data'] == hoje_str:
+                    relatorio['vendas_hoje'] += linha['quantidade']
                 
-            except Exception as e:
-                log_error("admin_relatorio_vendas", e)
-        else:
-            # Calcular em memória
-            hoje_str = hoje.isoformat()
+                if data_inicio <= linha['data'] <= data_fim:
+                    dia = totais_por_dia.setdefault(linha['data'], {'total': 0, 'receita': 0.0})
+                    dia['total'] += linha['quantidade']
+                    dia['receita'] += linha['receita']
             
-            for venda in memory_storage['vendas']:
-                if venda.get('status') == 'completed':
-                    if venda.get('tipo_jogo') == 'raspa_brasil':
-                        relatorio['vendas_rb'] += venda.get('quantidade', 0)
-                    elif venda.get('tipo_jogo') == '2para1000':
-                        relatorio['vendas_ml'] += venda.get('quantidade', 0)
-                    
-                    relatorio['receita_total'] += venda.get('valor_total', 0)
-                    
-                    if venda.get('data_criacao', '')[:10] == hoje_str:
-                        relatorio['vendas_hoje'] += venda.get('quantidade', 0)
-            
-            # Vendas dos últimos 7 dias em memória
-            for i in range(7):
-                dia = hoje - timedelta(days=i)
+            dia = date.fromisoformat(data_inicio)
+            while dia.isoformat() <= data_fim:
                 dia_str = dia.isoformat()
-                
-                total_dia = sum(
-                    v.get('quantidade', 0) for v in memory_storage['vendas']
-                    if v.get('data_criacao', '')[:10] == dia_str and v.get('status') == 'completed'
-                )
-                
-                vendas_7_dias.append({
+                valores = totais_por_dia.get(dia_str, {'total': 0, 'receita': 0.0})
+                relatorio['vendas_7_dias'].append({
                     'data': dia_str,
-                    'total': total_dia
+                    'total': valores['total'],
+                    'receita': valores['receita']
                 })
+                dia += timedelta(days=1)
             
-            relatorio['vendas_7_dias'] = list(reversed(vendas_7_dias))
+        except Exception as e:
+            log_error("admin_relatorio_vendas", e)
         
         log_info("admin_relatorio_vendas", f"Relatório gerado - RB: {relatorio['vendas_rb']}, ML: {relatorio['vendas_ml']}")
         return jsonify(relatorio)
@@ -3224,7 +4998,7 @@ if __name__ == '__main__':
     print("🚀 Iniciando GANHA BRASIL - Sistema Integrado v3.0.2...")
     print(f"🌐 Porta: {port}")
     print(f"💳 Mercado Pago: {'✅ Real' if sdk else '🔄 Simulado'}")
-    print(f"🔗 Supabase: {'✅ Conectado' if supabase else '🔄 Memória'}")
+    print(f"🔗 Supabase: {'✅ Conectado' if obter_supabase() else '🔄 Memória'}")
     print(f"📱 QR Code: {'✅ Disponível' if qrcode_available else '🔄 Texto'}")
     print(f"📄 PDF: {'✅ Disponível' if reportlab_available else '❌ Não disponível'}")
     print(f"🎮 Jogos Disponíveis:")
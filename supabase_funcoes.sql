@@ -0,0 +1,151 @@
+-- Funções e tabelas auxiliares usadas pelo app.py (via supabase.rpc e consultas diretas).
+-- Executar no SQL Editor do Supabase. Todas as instruções podem ser reexecutadas.
+
+-- Total de unidades vendidas (vendas aprovadas) de um jogo
+create or replace function gb_total_vendas(p_tipo_jogo text)
+returns bigint
+language sql
+stable
+as $$
+    select coalesce(sum(gb_quantidade), 0)::bigint
+    from gb_vendas
+    where gb_tipo_jogo = p_tipo_jogo
+      and gb_status = 'completed';
+$$;
+
+create index if not exists gb_vendas_tipo_status_idx on gb_vendas (gb_tipo_jogo, gb_status);
+
+-- Reservas de estoque compartilhadas por todos os workers (chave = payment_id da venda)
+create table if not exists gb_reservas_estoque (
+    gb_chave text primary key,
+    gb_tipo_jogo text not null default 'raspa_brasil',
+    gb_quantidade integer not null,
+    gb_expira_em timestamptz not null,
+    gb_data_criacao timestamptz not null default now()
+);
+
+create index if not exists gb_reservas_estoque_expira_idx on gb_reservas_estoque (gb_expira_em);
+create index if not exists gb_vendas_payment_id_idx on gb_vendas (gb_payment_id);
+
+-- Unidades reservadas e ainda válidas. Reservas cuja venda já foi aprovada não contam,
+-- para não somar a mesma unidade como vendida e reservada.
+create or replace function gb_estoque_reservado(p_tipo_jogo text)
+returns bigint
+language sql
+stable
+as $$
+    select coalesce(sum(r.gb_quantidade), 0)::bigint
+    from gb_reservas_estoque r
+    where r.gb_tipo_jogo = p_tipo_jogo
+      and r.gb_expira_em > now()
+      and not exists (
+          select 1 from gb_vendas v
+          where v.gb_payment_id = r.gb_chave and v.gb_status = 'completed'
+      );
+$$;
+
+-- Verifica o disponível e grava a reserva numa única transação. O lock consultivo serializa
+-- as reservas concorrentes, então duas compras não reservam a mesma unidade.
+create or replace function gb_reservar_estoque(
+    p_chave text,
+    p_quantidade integer,
+    p_total integer,
+    p_ttl_segundos integer,
+    p_tipo_jogo text default 'raspa_brasil'
+)
+returns table (reservado boolean, disponiveis bigint)
+language plpgsql
+as $$
+declare
+    v_disponiveis bigint;
+begin
+    perform pg_advisory_xact_lock(hashtext('gb_reservas_estoque:' || p_tipo_jogo));
+    
+    delete from gb_reservas_estoque where gb_expira_em <= now();
+    
+    v_disponiveis := p_total - gb_total_vendas(p_tipo_jogo) - gb_estoque_reservado(p_tipo_jogo);
+    if p_quantidade > v_disponiveis then
+        return query select false, greatest(v_disponiveis, 0);
+        return;
+    end if;
+    
+    insert into gb_reservas_estoque (gb_chave, gb_tipo_jogo, gb_quantidade, gb_expira_em)
+    values (p_chave, p_tipo_jogo, p_quantidade, now() + make_interval(secs => p_ttl_segundos));
+    
+    return query select true, v_disponiveis - p_quantidade;
+end;
+$$;
+
+-- Consolidado diário de vendas aprovadas (dia x jogo), mantido por gatilho em gb_vendas
+create table if not exists gb_vendas_diarias (
+    gb_data date not null,
+    gb_tipo_jogo text not null,
+    gb_quantidade bigint not null default 0,
+    gb_receita numeric(12, 2) not null default 0,
+    primary key (gb_data, gb_tipo_jogo)
+);
+
+create or replace function gb_consolidar_venda_diaria()
+returns trigger
+language plpgsql
+as $$
+begin
+    if new.gb_status = 'completed' and (tg_op = 'INSERT' or old.gb_status is distinct from 'completed') then
+        insert into gb_vendas_diarias (gb_data, gb_tipo_jogo, gb_quantidade, gb_receita)
+        values (new.gb_data_criacao::date, new.gb_tipo_jogo, new.gb_quantidade, new.gb_valor_total)
+        on conflict (gb_data, gb_tipo_jogo) do update
+            set gb_quantidade = gb_vendas_diarias.gb_quantidade + excluded.gb_quantidade,
+                gb_receita = gb_vendas_diarias.gb_receita + excluded.gb_receita;
+    end if;
+    return new;
+end;
+$$;
+
+drop trigger if exists gb_vendas_consolidar_diaria on gb_vendas;
+create trigger gb_vendas_consolidar_diaria
+    after insert or update of gb_status on gb_vendas
+    for each row execute function gb_consolidar_venda_diaria();
+
+-- Carga inicial / recálculo do consolidado a partir de gb_vendas. Sobrescreve os dias com o
+-- total real, então pode ser executado depois do gatilho e repetido quando necessário
+-- (de preferência com pouco tráfego, pois vendas aprovadas durante a execução podem ficar de fora).
+-- insert into gb_vendas_diarias (gb_data, gb_tipo_jogo, gb_quantidade, gb_receita)
+-- select gb_data_criacao::date, gb_tipo_jogo, sum(gb_quantidade), sum(gb_valor_total)
+-- from gb_vendas where gb_status = 'completed'
+-- group by 1, 2
+-- on conflict (gb_data, gb_tipo_jogo) do update
+--     set gb_quantidade = excluded.gb_quantidade,
+--         gb_receita = excluded.gb_receita;
+
+-- Uma milhar só pode ser vendida uma vez por sorteio. Antes de criar, conferir duplicidades:
+-- select gb_data_sorteio, gb_numero_bilhete, count(*) from gb_cliente_bilhetes
+-- group by 1, 2 having count(*) > 1;
+create unique index if not exists gb_cliente_bilhetes_sorteio_numero_uidx
+    on gb_cliente_bilhetes (gb_data_sorteio, gb_numero_bilhete);
+
+-- Incremento atômico dos contadores do afiliado (col = col + delta em um único update)
+create or replace function gb_incrementar_afiliado(
+    p_afiliado_id bigint,
+    p_clicks integer default 0,
+    p_vendas integer default 0,
+    p_comissao numeric default 0
+)
+returns setof gb_afiliados
+language sql
+as $$
+    update gb_afiliados
+    set gb_total_clicks = coalesce(gb_total_clicks, 0) + p_clicks,
+        gb_total_vendas = coalesce(gb_total_vendas, 0) + p_vendas,
+        gb_total_comissao = coalesce(gb_total_comissao, 0) + p_comissao,
+        gb_saldo_disponivel = coalesce(gb_saldo_disponivel, 0) + p_comissao
+    where gb_id = p_afiliado_id
+    returning *;
+$$;
+
+-- Marca de emissão dos bilhetes do 2 para 1000: a aplicação reivindica a venda com
+-- update ... set gb_bilhetes_emitidos = true where gb_bilhetes_emitidos = false, então só um
+-- pedido aloca as milhares. As vendas que já têm bilhetes são marcadas na criação da coluna.
+alter table gb_vendas add column if not exists gb_bilhetes_emitidos boolean not null default false;
+update gb_vendas v set gb_bilhetes_emitidos = true
+where not v.gb_bilhetes_emitidos
+  and exists (select 1 from gb_cliente_bilhetes b where b.gb_venda_id = v.gb_id);